@@ -3,15 +3,22 @@ from typing import Dict, Any, Optional
 import time
 from app.utils.logger import log_agent_action
 
+# Monotonic clock so NTP adjustments can't produce negative execution times
+_perf_counter_ns = time.perf_counter_ns
+
 class BaseAgent(ABC):
     """Base class for all agents"""
     
+    # Agents are long-lived singletons per router; no per-instance __dict__
+    __slots__ = ("agent_name", "_cls_name")
+    
     def __init__(self, agent_name: str):
         self.agent_name = agent_name
+        self._cls_name = type(self).__name__
     
     async def execute(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
         """Execute agent logic with logging"""
-        start_time = time.time()
+        start_ns = _perf_counter_ns()
         status = "success"
         error_message = None
         output_data = {}
@@ -25,10 +32,10 @@ class BaseAgent(ABC):
             raise
         
         finally:
-            execution_time_ms = (time.time() - start_time) * 1000
-            await log_agent_action(
+            execution_time_ms = (_perf_counter_ns() - start_ns) / 1_000_000
+            log_agent_action(
                 agent_name=self.agent_name,
-                action=self.__class__.__name__,
+                action=self._cls_name,
                 input_data=input_data,
                 output_data=output_data,
                 execution_time_ms=execution_time_ms,
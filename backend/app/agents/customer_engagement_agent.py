@@ -1,11 +1,101 @@
-from typing import Dict, Any
-from datetime import datetime
+import asyncio
+import bisect
+import re
+from typing import Dict, Any, FrozenSet, List, Optional, Pattern, Tuple, TypedDict
+from datetime import datetime, timezone
 from app.agents.base_agent import BaseAgent
 from app.core.database import get_database
+from app.core.mongo_cache import get_customer, get_vehicle, get_latest_telemetry
+
+# Chat intents in priority order - the first intent with a keyword contained in
+# the message wins. Built once at import instead of on every chat turn.
+INTENT_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    "greeting": ("hello", "hi", "hey", "good morning", "good afternoon"),
+    "status": ("status", "health", "condition", "how is my vehicle", "vehicle status"),
+    "alert": ("alert", "warning", "issue", "problem", "risk"),
+    "service": ("service", "appointment", "schedule", "book", "maintenance", "repair"),
+    "confirm": ("yes", "sure", "okay", "ok", "confirm", "proceed"),
+    "decline": ("no", "not now", "later", "cancel"),
+    "temperature": ("temperature", "engine temp", "overheating"),
+    "oil": ("oil", "oil pressure", "pressure"),
+    "battery": ("battery", "voltage", "electrical"),
+    "help": ("what", "help", "information", "info"),
+    "thanks": ("thank", "thanks", "appreciate"),
+}
+
+# Lookups each intent's reply actually reads; intents not listed fall back to
+# the default reply, which only needs the vehicle name
+_INTENT_NEEDS: Dict[Optional[str], FrozenSet[str]] = {
+    "greeting": frozenset({"vehicle", "alerts"}),
+    "status": frozenset({"vehicle", "telemetry"}),
+    "alert": frozenset({"vehicle", "telemetry", "alerts"}),
+    "service": frozenset({"alerts"}),
+    "confirm": frozenset(),
+    "decline": frozenset(),
+    "temperature": frozenset({"telemetry"}),
+    "oil": frozenset({"telemetry"}),
+    "battery": frozenset({"telemetry"}),
+    "help": frozenset({"vehicle"}),
+    "thanks": frozenset(),
+}
+_DEFAULT_NEEDS: FrozenSet[str] = frozenset({"vehicle"})
+
+# Alert templates by risk band; a score equal to a threshold stays in the lower band
+ALERT_RISK_THRESHOLDS = (0.3, 0.5, 0.7)
+ALERT_TEMPLATES = (
+    "✅ Your {model} is operating normally. Continue regular maintenance as scheduled.",
+    "ℹ️ NOTICE: Your {model} has some risk indicators. We suggest scheduling a preventive maintenance check soon.",
+    "⚠️ ALERT: Your {model} shows elevated risk indicators. We recommend scheduling service within 7 days to prevent potential breakdowns.",
+    "🚨 URGENT: Your {model} requires immediate attention. High failure risk detected. Please schedule service immediately or call our emergency line.",
+)
+
+# Secondary keyword sets used inside the service/confirm replies
+BOOKING_ACCEPT_KEYWORDS: Tuple[str, ...] = ("yes", "sure", "okay", "ok", "please", "book")
+BOOKING_KEYWORDS: Tuple[str, ...] = ("service", "appointment", "book")
+
+
+class AlertResponse(TypedDict):
+    """Successful send_alert result"""
+    status: str
+    customer_id: str
+    customer_name: Optional[str]
+    message: str
+    message_type: str
+    sent_at: datetime
+
+
+class ChatResponse(TypedDict):
+    """Successful get_chat_response result"""
+    status: str
+    response: str
+    timestamp: datetime
+
+
+def _compile_keywords(keywords: Tuple[str, ...]) -> Pattern:
+    """Compile keywords into one alternation matching any of them as a substring"""
+    return re.compile("|".join(re.escape(word) for word in keywords))
+
+
+_INTENT_PATTERNS: List[Tuple[Pattern, str]] = [
+    (_compile_keywords(keywords), intent) for intent, keywords in INTENT_KEYWORDS.items()
+]
+_BOOKING_ACCEPT_PATTERN = _compile_keywords(BOOKING_ACCEPT_KEYWORDS)
+_BOOKING_PATTERN = _compile_keywords(BOOKING_KEYWORDS)
+
+
+def classify_intent(message_lower: str) -> Optional[str]:
+    """Return the highest-priority chat intent matched by the message, if any"""
+    for pattern, intent in _INTENT_PATTERNS:
+        if pattern.search(message_lower):
+            return intent
+    return None
+
 
 class CustomerEngagementAgent(BaseAgent):
     """Handles customer communication and engagement"""
     
+    __slots__ = ()
+    
     def __init__(self):
         super().__init__("CustomerEngagementAgent")
     
@@ -28,12 +118,12 @@ class CustomerEngagementAgent(BaseAgent):
         db = get_database()
         
         # Get customer info
-        customer = await db.customers.find_one({"customer_id": customer_id})
+        customer = await get_customer(customer_id)
         if not customer:
             return {"status": "error", "message": "Customer not found"}
         
         # Get vehicle info
-        vehicle = await db.vehicles.find_one({"vin": vin})
+        vehicle = await get_vehicle(vin)
         if not vehicle:
             return {"vehicle": None}
         
@@ -41,202 +131,236 @@ class CustomerEngagementAgent(BaseAgent):
         message = self._generate_alert_message(risk_score, vehicle, message_type)
         
         # Store notification
+        now = datetime.now(timezone.utc)
         notification = {
             "customer_id": customer_id,
             "vin": vin,
             "message": message,
             "message_type": message_type,
             "risk_score": risk_score,
-            "timestamp": datetime.utcnow(),
+            "timestamp": now,
             "read": False
         }
         await db.notifications.insert_one(notification)
         
-        return {
+        result: AlertResponse = {
             "status": "success",
             "customer_id": customer_id,
             "customer_name": customer.get("name"),
             "message": message,
             "message_type": message_type,
-            "sent_at": datetime.utcnow().isoformat()
+            "sent_at": now
         }
+        return result
     
     def _generate_alert_message(self, risk_score: float, vehicle: Dict[str, Any], message_type: str) -> str:
         """Generate alert message based on risk score"""
         model = vehicle.get("model", "vehicle")
-        
-        if risk_score > 0.7:
-            return f"🚨 URGENT: Your {model} requires immediate attention. High failure risk detected. Please schedule service immediately or call our emergency line."
-        elif risk_score > 0.5:
-            return f"⚠️ ALERT: Your {model} shows elevated risk indicators. We recommend scheduling service within 7 days to prevent potential breakdowns."
-        elif risk_score > 0.3:
-            return f"ℹ️ NOTICE: Your {model} has some risk indicators. We suggest scheduling a preventive maintenance check soon."
-        else:
-            return f"✅ Your {model} is operating normally. Continue regular maintenance as scheduled."
+        band = bisect.bisect_left(ALERT_RISK_THRESHOLDS, risk_score)
+        return ALERT_TEMPLATES[band].format(model=model)
     
     async def _handle_chat(self, message: str, customer_id: str, vin: str) -> Dict[str, Any]:
         """Handle customer chat message with enhanced responses"""
         db = get_database()
         message_lower = message.lower().strip()
+        intent = classify_intent(message_lower)
         
-        # Get vehicle info
-        vehicle = await db.vehicles.find_one({"vin": vin}) if vin else None
-        vehicle_name = vehicle.get("vehicle_name") if vehicle else "your vehicle"
-        vehicle_model = vehicle.get("model") if vehicle else "vehicle"
-        
-        # Get latest telemetry and prediction
+        # Only fetch what the matched intent's reply reads; anonymous sessions skip the DB
+        vehicle = None
         latest_telemetry = None
-        if vin:
-            latest_telemetry = await db.vehicle_telemetry.find_one(
-                {"vin": vin},
-                sort=[("timestamp", -1)]
-            )
-        
-        # Get active alerts for this vehicle
         active_alerts = []
-        if vin:
-            alerts = await db.notifications.find({
-                "vin": vin,
-                "read": False
-            }).sort("timestamp", -1).limit(5).to_list(5)
-            active_alerts = alerts
-        
-        # Enhanced rule-based responses
-        if any(word in message_lower for word in ["hello", "hi", "hey", "good morning", "good afternoon"]):
-            greeting = "Hello! I'm your vehicle assistant. "
-            if active_alerts:
-                alert_msg = active_alerts[0].get("message", "")
-                response = f"{greeting}I have an important alert for you: {alert_msg} Would you like to schedule a service appointment?"
-            else:
-                response = f"{greeting}I'm here to help with {vehicle_name}. How can I assist you today?"
-        
-        elif any(word in message_lower for word in ["status", "health", "condition", "how is my vehicle", "vehicle status"]):
-            if latest_telemetry:
-                health = latest_telemetry.get("health_score", 100)
-                risk = latest_telemetry.get("prediction_risk", 0)
-                
-                response = f"Your {vehicle_model} ({vehicle_name}) has a health score of {health:.1f}/100. "
-                
-                if health < 50:
-                    response += f"⚠️ This is concerning. Your vehicle shows high risk indicators ({risk*100:.0f}% failure risk). "
-                    response += "I strongly recommend scheduling service immediately. Would you like me to help you book an appointment?"
-                elif health < 70:
-                    response += f"⚠️ There are some risk indicators present ({risk*100:.0f}% failure risk). "
-                    response += "I recommend scheduling preventive maintenance within 7-10 days. Would you like to book a service?"
-                elif health < 80:
-                    response += "The vehicle is in fair condition. Regular maintenance is recommended soon."
-                else:
-                    response += "✅ Everything looks good! Your vehicle is operating normally."
-            else:
-                response = f"I don't have recent telemetry data for {vehicle_name}. Please check back later or contact support."
-        
-        elif any(word in message_lower for word in ["alert", "warning", "issue", "problem", "risk"]):
-            if active_alerts:
-                alert = active_alerts[0]
-                response = f"⚠️ Alert: {alert.get('message', 'There is an issue with your vehicle.')} "
-                response += "Would you like to schedule a service appointment to address this?"
-            elif latest_telemetry:
-                risk = latest_telemetry.get("prediction_risk", 0)
-                health = latest_telemetry.get("health_score", 100)
-                if risk > 0.5 or health < 70:
-                    response = f"We detected potential issues with {vehicle_name}. "
-                    response += f"Health score: {health:.1f}/100, Risk: {risk*100:.0f}%. "
-                    response += "Would you like to schedule a service appointment?"
-                else:
-                    response = f"Good news! {vehicle_name} is currently operating normally. No immediate alerts."
-            else:
-                response = "I don't have recent data. Please check the dashboard for alerts or contact support."
-        
-        elif any(word in message_lower for word in ["service", "appointment", "schedule", "book", "maintenance", "repair"]):
-            if any(word in message_lower for word in ["yes", "sure", "okay", "ok", "please", "book"]):
-                response = "Great! I can help you schedule a service appointment. "
-                response += "Please click the 'Confirm Service Booking' button in the alerts section above, "
-                response += "or I can guide you through the process. Which service center would you prefer?"
-            else:
-                response = "I can help you schedule a service appointment for your vehicle. "
-                if active_alerts:
-                    response += "I see you have active alerts. Would you like to book a service now? "
-                response += "You can click 'Confirm Service Booking' in the alerts section, or tell me if you'd like to proceed."
-        
-        elif any(word in message_lower for word in ["yes", "sure", "okay", "ok", "confirm", "proceed"]):
-            if any(word in message_lower for word in ["service", "appointment", "book"]):
-                response = "Perfect! Please click the 'Confirm Service Booking' button in the alerts section above. "
-                response += "You'll be able to select a service center and preferred time slot."
-            else:
-                response = "Great! How can I help you further? You can ask about your vehicle's health, schedule service, or get information about maintenance."
-        
-        elif any(word in message_lower for word in ["no", "not now", "later", "cancel"]):
-            response = "No problem! Feel free to reach out whenever you're ready to schedule service or if you have any questions about your vehicle."
+        needs = _INTENT_NEEDS.get(intent, _DEFAULT_NEEDS) if vin else frozenset()
+        if needs:
+            lookups = {}
+            if "vehicle" in needs:
+                lookups["vehicle"] = get_vehicle(vin)
+            if "telemetry" in needs:
+                lookups["telemetry"] = get_latest_telemetry(vin)
+            if "alerts" in needs:
+                lookups["alerts"] = db.notifications.find({
+                    "vin": vin,
+                    "read": False
+                }, {"_id": 0, "message": 1}).sort("timestamp", -1).limit(5).to_list(5)
+            fetched = dict(zip(lookups, await asyncio.gather(*lookups.values())))
+            vehicle = fetched.get("vehicle")
+            latest_telemetry = fetched.get("telemetry")
+            active_alerts = fetched.get("alerts", [])
         
-        elif any(word in message_lower for word in ["temperature", "engine temp", "overheating"]):
-            if latest_telemetry:
-                temp = latest_telemetry.get("engine_temperature", 85)
-                response = f"Your engine temperature is currently {temp:.1f}°C. "
-                if temp > 100:
-                    response += "⚠️ This is higher than normal. Your engine may be overheating. I recommend scheduling service soon."
-                elif temp > 95:
-                    response += "This is slightly elevated. Monitor it closely."
-                else:
-                    response += "This is within normal operating range."
-            else:
-                response = "I don't have current temperature data. Please check back later."
-        
-        elif any(word in message_lower for word in ["oil", "oil pressure", "pressure"]):
-            if latest_telemetry:
-                pressure = latest_telemetry.get("oil_pressure", 45)
-                response = f"Your oil pressure is currently {pressure:.1f} PSI. "
-                if pressure < 25:
-                    response += "⚠️ This is critically low! Please schedule service immediately."
-                elif pressure < 35:
-                    response += "This is below optimal. I recommend checking your oil level and scheduling service."
-                else:
-                    response += "This is within normal range."
-            else:
-                response = "I don't have current oil pressure data. Please check back later."
-        
-        elif any(word in message_lower for word in ["battery", "voltage", "electrical"]):
-            if latest_telemetry:
-                voltage = latest_telemetry.get("battery_voltage", 12.6)
-                response = f"Your battery voltage is currently {voltage:.2f}V. "
-                if voltage < 11.5:
-                    response += "⚠️ This is low. Your battery may need charging or replacement. Schedule service soon."
-                elif voltage < 12.0:
-                    response += "This is slightly low. Monitor it and consider checking your battery."
-                else:
-                    response += "This is within normal range."
-            else:
-                response = "I don't have current battery data. Please check back later."
-        
-        elif any(word in message_lower for word in ["what", "help", "information", "info"]):
-            response = f"I can help you with information about {vehicle_name}. You can ask me about: "
-            response += "• Vehicle health status and risk indicators\n"
-            response += "• Engine temperature, oil pressure, battery voltage\n"
-            response += "• Scheduling service appointments\n"
-            response += "• Understanding alerts and warnings\n"
-            response += "Just ask me anything about your vehicle!"
-        
-        elif any(word in message_lower for word in ["thank", "thanks", "appreciate"]):
-            response = "You're welcome! I'm here whenever you need help with your vehicle. Is there anything else I can assist you with?"
+        context = {
+            "message_lower": message_lower,
+            "vehicle_name": vehicle.get("vehicle_name") if vehicle else "your vehicle",
+            "vehicle_model": vehicle.get("model") if vehicle else "vehicle",
+            "telemetry": latest_telemetry,
+            "alerts": active_alerts,
+        }
         
-        else:
-            # Default response with helpful suggestions
-            response = f"I understand you're asking about {vehicle_name}. "
-            response += "I can help you with vehicle health status, scheduling service, or answering questions about maintenance. "
-            response += "Could you please rephrase your question or ask about: health status, service booking, or vehicle alerts?"
+        # Enhanced rule-based responses
+        handler = self._INTENT_HANDLERS.get(intent, CustomerEngagementAgent._reply_default)
+        response = handler(self, context)
         
         # Store chat history
+        now = datetime.now(timezone.utc)
         chat_entry = {
             "customer_id": customer_id,
             "vin": vin,
             "user_message": message,
             "bot_response": response,
-            "timestamp": datetime.utcnow()
+            "timestamp": now
         }
         await db.chat_history.insert_one(chat_entry)
         
-        return {
+        result: ChatResponse = {
             "status": "success",
             "response": response,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": now
         }
-
+        return result
+    
+    def _reply_greeting(self, context: Dict[str, Any]) -> str:
+        greeting = "Hello! I'm your vehicle assistant. "
+        active_alerts = context["alerts"]
+        if active_alerts:
+            alert_msg = active_alerts[0].get("message", "")
+            return f"{greeting}I have an important alert for you: {alert_msg} Would you like to schedule a service appointment?"
+        return f"{greeting}I'm here to help with {context['vehicle_name']}. How can I assist you today?"
+    
+    def _reply_status(self, context: Dict[str, Any]) -> str:
+        latest_telemetry = context["telemetry"]
+        vehicle_name = context["vehicle_name"]
+        if not latest_telemetry:
+            return f"I don't have recent telemetry data for {vehicle_name}. Please check back later or contact support."
+        
+        health = latest_telemetry.get("health_score", 100)
+        risk = latest_telemetry.get("prediction_risk", 0)
+        
+        response = f"Your {context['vehicle_model']} ({vehicle_name}) has a health score of {health:.1f}/100. "
+        
+        if health < 50:
+            response += f"⚠️ This is concerning. Your vehicle shows high risk indicators ({risk*100:.0f}% failure risk). "
+            response += "I strongly recommend scheduling service immediately. Would you like me to help you book an appointment?"
+        elif health < 70:
+            response += f"⚠️ There are some risk indicators present ({risk*100:.0f}% failure risk). "
+            response += "I recommend scheduling preventive maintenance within 7-10 days. Would you like to book a service?"
+        elif health < 80:
+            response += "The vehicle is in fair condition. Regular maintenance is recommended soon."
+        else:
+            response += "✅ Everything looks good! Your vehicle is operating normally."
+        return response
+    
+    def _reply_alert(self, context: Dict[str, Any]) -> str:
+        active_alerts = context["alerts"]
+        latest_telemetry = context["telemetry"]
+        vehicle_name = context["vehicle_name"]
+        if active_alerts:
+            alert = active_alerts[0]
+            response = f"⚠️ Alert: {alert.get('message', 'There is an issue with your vehicle.')} "
+            response += "Would you like to schedule a service appointment to address this?"
+            return response
+        if latest_telemetry:
+            risk = latest_telemetry.get("prediction_risk", 0)
+            health = latest_telemetry.get("health_score", 100)
+            if risk > 0.5 or health < 70:
+                response = f"We detected potential issues with {vehicle_name}. "
+                response += f"Health score: {health:.1f}/100, Risk: {risk*100:.0f}%. "
+                response += "Would you like to schedule a service appointment?"
+                return response
+            return f"Good news! {vehicle_name} is currently operating normally. No immediate alerts."
+        return "I don't have recent data. Please check the dashboard for alerts or contact support."
+    
+    def _reply_service(self, context: Dict[str, Any]) -> str:
+        if _BOOKING_ACCEPT_PATTERN.search(context["message_lower"]):
+            response = "Great! I can help you schedule a service appointment. "
+            response += "Please click the 'Confirm Service Booking' button in the alerts section above, "
+            response += "or I can guide you through the process. Which service center would you prefer?"
+            return response
+        response = "I can help you schedule a service appointment for your vehicle. "
+        if context["alerts"]:
+            response += "I see you have active alerts. Would you like to book a service now? "
+        response += "You can click 'Confirm Service Booking' in the alerts section, or tell me if you'd like to proceed."
+        return response
+    
+    def _reply_confirm(self, context: Dict[str, Any]) -> str:
+        if _BOOKING_PATTERN.search(context["message_lower"]):
+            response = "Perfect! Please click the 'Confirm Service Booking' button in the alerts section above. "
+            response += "You'll be able to select a service center and preferred time slot."
+            return response
+        return "Great! How can I help you further? You can ask about your vehicle's health, schedule service, or get information about maintenance."
+    
+    def _reply_decline(self, context: Dict[str, Any]) -> str:
+        return "No problem! Feel free to reach out whenever you're ready to schedule service or if you have any questions about your vehicle."
+    
+    def _reply_temperature(self, context: Dict[str, Any]) -> str:
+        latest_telemetry = context["telemetry"]
+        if not latest_telemetry:
+            return "I don't have current temperature data. Please check back later."
+        temp = latest_telemetry.get("engine_temperature", 85)
+        response = f"Your engine temperature is currently {temp:.1f}°C. "
+        if temp > 100:
+            response += "⚠️ This is higher than normal. Your engine may be overheating. I recommend scheduling service soon."
+        elif temp > 95:
+            response += "This is slightly elevated. Monitor it closely."
+        else:
+            response += "This is within normal operating range."
+        return response
+    
+    def _reply_oil(self, context: Dict[str, Any]) -> str:
+        latest_telemetry = context["telemetry"]
+        if not latest_telemetry:
+            return "I don't have current oil pressure data. Please check back later."
+        pressure = latest_telemetry.get("oil_pressure", 45)
+        response = f"Your oil pressure is currently {pressure:.1f} PSI. "
+        if pressure < 25:
+            response += "⚠️ This is critically low! Please schedule service immediately."
+        elif pressure < 35:
+            response += "This is below optimal. I recommend checking your oil level and scheduling service."
+        else:
+            response += "This is within normal range."
+        return response
+    
+    def _reply_battery(self, context: Dict[str, Any]) -> str:
+        latest_telemetry = context["telemetry"]
+        if not latest_telemetry:
+            return "I don't have current battery data. Please check back later."
+        voltage = latest_telemetry.get("battery_voltage", 12.6)
+        response = f"Your battery voltage is currently {voltage:.2f}V. "
+        if voltage < 11.5:
+            response += "⚠️ This is low. Your battery may need charging or replacement. Schedule service soon."
+        elif voltage < 12.0:
+            response += "This is slightly low. Monitor it and consider checking your battery."
+        else:
+            response += "This is within normal range."
+        return response
+    
+    def _reply_help(self, context: Dict[str, Any]) -> str:
+        response = f"I can help you with information about {context['vehicle_name']}. You can ask me about: "
+        response += "• Vehicle health status and risk indicators\n"
+        response += "• Engine temperature, oil pressure, battery voltage\n"
+        response += "• Scheduling service appointments\n"
+        response += "• Understanding alerts and warnings\n"
+        response += "Just ask me anything about your vehicle!"
+        return response
+    
+    def _reply_thanks(self, context: Dict[str, Any]) -> str:
+        return "You're welcome! I'm here whenever you need help with your vehicle. Is there anything else I can assist you with?"
+    
+    def _reply_default(self, context: Dict[str, Any]) -> str:
+        # Default response with helpful suggestions
+        response = f"I understand you're asking about {context['vehicle_name']}. "
+        response += "I can help you with vehicle health status, scheduling service, or answering questions about maintenance. "
+        response += "Could you please rephrase your question or ask about: health status, service booking, or vehicle alerts?"
+        return response
+    
+    # Intent -> reply builder, resolved once at class creation
+    _INTENT_HANDLERS = {
+        "greeting": _reply_greeting,
+        "status": _reply_status,
+        "alert": _reply_alert,
+        "service": _reply_service,
+        "confirm": _reply_confirm,
+        "decline": _reply_decline,
+        "temperature": _reply_temperature,
+        "oil": _reply_oil,
+        "battery": _reply_battery,
+        "help": _reply_help,
+        "thanks": _reply_thanks,
+    }
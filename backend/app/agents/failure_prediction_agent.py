@@ -1,18 +1,134 @@
-from typing import Dict, Any, List
+import asyncio
+import bisect
+import operator
+import time
+from typing import Dict, Any, List, Optional, Tuple
 import numpy as np
 from sklearn.ensemble import IsolationForest
 from app.agents.base_agent import BaseAgent
 from app.core.database import get_database
+from app.core.mongo_cache import invalidate_telemetry
 from app.models.vehicle import VehicleTelemetry
 
+# Numeric telemetry features used for risk scoring, with defaults for missing fields
+RISK_FEATURES = ("health_score", "engine_temperature", "oil_pressure", "vibration_level", "battery_voltage")
+FEATURE_DEFAULTS = {
+    "health_score": 100.0,
+    "engine_temperature": 85.0,
+    "oil_pressure": 45.0,
+    "vibration_level": 0.5,
+    "battery_voltage": 12.6,
+}
+
+# Fields read by risk scoring; _id is needed to write back prediction_risk
+TELEMETRY_RISK_PROJECTION = {
+    "_id": 1, "timestamp": 1, "error_codes": 1, "anomaly_detected": 1,
+    **{feature: 1 for feature in RISK_FEATURES},
+}
+
+# (comparison, threshold, risk weight) tiers per sensor, most severe first
+RISK_TIERS = {
+    "engine_temperature": ((">", 105, 0.25), (">", 95, 0.15), ("<", 70, 0.1)),  # too cold can also indicate issues
+    "oil_pressure": (("<", 25, 0.3), ("<", 35, 0.2), (">", 60, 0.1)),
+    "vibration_level": ((">", 1.0, 0.2), (">", 0.8, 0.1)),
+    "battery_voltage": (("<", 11.5, 0.25), ("<", 12.0, 0.15), (">", 14.5, 0.1)),  # overcharging
+}
+
+# RISK_TIERS resolved once at import into (column, comparisons, weights) so
+# scoring does no per-call dict lookups or operator-string dispatch
+_COMPARATORS = {">": operator.gt, "<": operator.lt}
+_COMPILED_RISK_TIERS = tuple(
+    (
+        RISK_FEATURES.index(feature),
+        tuple((_COMPARATORS[op], limit) for op, limit, _ in tiers),
+        [weight for _, _, weight in tiers],
+    )
+    for feature, tiers in RISK_TIERS.items()
+)
+
+# (predicted failure window, recommendation) per risk band; a score equal to a
+# threshold stays in the lower band
+RISK_BAND_THRESHOLDS = (0.3, 0.5, 0.7)
+RISK_BANDS = (
+    ("No immediate risk detected", "Vehicle is in good condition. Regular maintenance recommended."),
+    ("30-60 days", "Low risk detected. Schedule preventive maintenance within 14-21 days."),
+    ("7-14 days", "Moderate risk detected. Schedule service within 7-10 days."),
+    ("3-5 days", "High risk detected. Immediate service recommended within 3-5 days."),
+)
+
+
+def _risk_band(risk_score: float) -> Tuple[str, str]:
+    return RISK_BANDS[bisect.bisect_left(RISK_BAND_THRESHOLDS, risk_score)]
+
+
+def _telemetry_matrix(telemetry_rows: List[Dict[str, Any]]) -> np.ndarray:
+    """Build an (n_rows, n_features) float matrix; missing values become NaN"""
+    values = (
+        t.get(feature, FEATURE_DEFAULTS[feature])
+        for t in telemetry_rows
+        for feature in RISK_FEATURES
+    )
+    return np.fromiter(
+        (np.nan if v is None else v for v in values),
+        dtype=np.float64,
+        count=len(telemetry_rows) * len(RISK_FEATURES),
+    ).reshape(-1, len(RISK_FEATURES))
+
+
+# Fleet-wide anomaly model, fitted once from recent telemetry and shared by all
+# agent instances. Refit is only retried (at most every MODEL_RETRY_SECONDS)
+# while there is not yet enough telemetry to train on.
+MODEL_TRAINING_ROWS = 2000
+MODEL_MIN_TRAINING_ROWS = 50
+MODEL_RETRY_SECONDS = 300
+
+_FEATURE_FILL = np.array([FEATURE_DEFAULTS[f] for f in RISK_FEATURES])
+_shared_model: Optional[IsolationForest] = None
+_shared_model_checked_at = float("-inf")
+_shared_model_lock = asyncio.Lock()
+
+
+def _fill_missing(X: np.ndarray) -> np.ndarray:
+    return np.where(np.isnan(X), _FEATURE_FILL, X)
+
+
+def _fit_model(X: np.ndarray) -> IsolationForest:
+    model = IsolationForest(contamination=0.1, random_state=42)
+    model.fit(X)
+    return model
+
+
+async def get_shared_model() -> Optional[IsolationForest]:
+    """Get the shared IsolationForest, fitting it on first use"""
+    global _shared_model, _shared_model_checked_at
+    if _shared_model is not None or time.monotonic() - _shared_model_checked_at < MODEL_RETRY_SECONDS:
+        return _shared_model
+    
+    async with _shared_model_lock:
+        if _shared_model is not None or time.monotonic() - _shared_model_checked_at < MODEL_RETRY_SECONDS:
+            return _shared_model
+        _shared_model_checked_at = time.monotonic()
+        
+        db = get_database()
+        training_rows = await db.vehicle_telemetry.find({}, TELEMETRY_RISK_PROJECTION).sort("timestamp", -1).limit(
+            MODEL_TRAINING_ROWS
+        ).to_list(MODEL_TRAINING_ROWS)
+        if len(training_rows) < MODEL_MIN_TRAINING_ROWS:
+            return None
+        
+        X = _fill_missing(_telemetry_matrix(training_rows))
+        # Fitting is CPU-bound; keep it off the event loop
+        _shared_model = await asyncio.to_thread(_fit_model, X)
+        return _shared_model
+
+
 class FailurePredictionAgent(BaseAgent):
     """Predicts potential vehicle failures using ML models"""
     
+    __slots__ = ()
+    
     def __init__(self):
         super().__init__("FailurePredictionAgent")
-        # Initialize Isolation Forest for anomaly detection
-        self.model = IsolationForest(contamination=0.1, random_state=42)
-        self.is_fitted = False
     
     async def _execute(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
         vin = input_data.get("vin")
@@ -23,7 +139,7 @@ class FailurePredictionAgent(BaseAgent):
         
         # Get recent telemetry data for this vehicle
         recent_telemetry = await db.vehicle_telemetry.find(
-            {"vin": vin}
+            {"vin": vin}, TELEMETRY_RISK_PROJECTION
         ).sort("timestamp", -1).limit(50).to_list(50)
         
         if not recent_telemetry:
@@ -32,27 +148,29 @@ class FailurePredictionAgent(BaseAgent):
         # Get latest telemetry
         latest = recent_telemetry[0]
         
-        # Calculate failure risk
-        risk_score = self._calculate_risk_score(latest)
+        # Flag the latest reading if the shared anomaly model considers it an outlier
+        model_anomalies = None
+        model = await get_shared_model()
+        if model is not None:
+            model_anomalies = np.zeros(len(recent_telemetry), dtype=bool)
+            model_anomalies[0] = model.predict(_fill_missing(_telemetry_matrix(recent_telemetry[:1])))[0] == -1
+        
+        # Calculate failure risk over the window; the latest row drives the prediction
+        risk_scores = self._calculate_risk_scores(recent_telemetry, model_anomalies)
+        risk_score = round(float(risk_scores[0]), 3)
         
         # Update telemetry with prediction risk
         await db.vehicle_telemetry.update_one(
             {"_id": latest["_id"]},
             {"$set": {"prediction_risk": risk_score}}
         )
+        invalidate_telemetry(vin)
         
         # Determine if action is needed
         needs_action = risk_score > 0.6
         
-        # Determine predicted failure window
-        if risk_score > 0.7:
-            failure_window = "3-5 days"
-        elif risk_score > 0.5:
-            failure_window = "7-14 days"
-        elif risk_score > 0.3:
-            failure_window = "30-60 days"
-        else:
-            failure_window = "No immediate risk detected"
+        # Determine predicted failure window and recommendation
+        failure_window, recommendation = _risk_band(risk_score)
         
         return {
             "status": "success",
@@ -60,88 +178,57 @@ class FailurePredictionAgent(BaseAgent):
             "risk_score": risk_score,
             "health_score": latest.get("health_score", 100),
             "needs_action": needs_action,
-            "recommendation": self._get_recommendation(risk_score, latest),
+            "recommendation": recommendation,
             "predicted_failure_window": failure_window
         }
     
-    def _calculate_risk_score(self, telemetry: Dict[str, Any]) -> float:
-        """Calculate failure risk score (0-1) based on telemetry data"""
-        risk_factors = []
-        
-        # Health score is the primary indicator - inverse relationship
-        health = telemetry.get("health_score", 100)
-        if health is not None:
-            # Convert health score (0-100) to risk score (0-1)
-            # Lower health = higher risk
-            health_risk = (100 - health) / 100.0
-            # Weight health score heavily (40% of total risk)
-            risk_factors.append(health_risk * 0.4)
-        
-        # Engine temperature risk
-        temp = telemetry.get("engine_temperature", 85)
-        if temp > 105:
-            risk_factors.append(0.25)
-        elif temp > 95:
-            risk_factors.append(0.15)
-        elif temp < 70:
-            risk_factors.append(0.1)  # Too cold can also indicate issues
-        
-        # Oil pressure risk
-        pressure = telemetry.get("oil_pressure", 45)
-        if pressure < 25:
-            risk_factors.append(0.3)
-        elif pressure < 35:
-            risk_factors.append(0.2)
-        elif pressure > 60:
-            risk_factors.append(0.1)  # Too high pressure
-        
-        # Vibration risk
-        vibration = telemetry.get("vibration_level", 0.5)
-        if vibration > 1.0:  # Adjusted threshold for realistic values
-            risk_factors.append(0.2)
-        elif vibration > 0.8:
-            risk_factors.append(0.1)
-        
-        # Battery risk
-        voltage = telemetry.get("battery_voltage", 12.6)
-        if voltage < 11.5:
-            risk_factors.append(0.25)
-        elif voltage < 12.0:
-            risk_factors.append(0.15)
-        elif voltage > 14.5:
-            risk_factors.append(0.1)  # Overcharging
+    def _calculate_risk_scores(
+        self,
+        telemetry_rows: List[Dict[str, Any]],
+        model_anomalies: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Calculate failure risk scores (0-1) for a window of telemetry rows in one pass"""
+        X = _telemetry_matrix(telemetry_rows)
+        
+        # Health score is the primary indicator - inverse relationship,
+        # weighted heavily (40% of total risk)
+        health = X[:, 0]
+        total_risk = np.where(np.isnan(health), 0.0, (100 - health) / 100.0 * 0.4)
+        
+        # Threshold tiers per sensor - first matching tier wins
+        for col, comparisons, weights in _COMPILED_RISK_TIERS:
+            values = X[:, col]
+            conditions = [compare(values, limit) for compare, limit in comparisons]
+            total_risk = total_risk + np.select(conditions, weights, default=0.0)
         
         # Error codes risk
-        error_codes = telemetry.get("error_codes", [])
-        if isinstance(error_codes, list):
-            risk_factors.append(min(0.3, len(error_codes) * 0.15))
-        
-        # Anomaly detection flag
-        if telemetry.get("anomaly_detected", False):
-            risk_factors.append(0.2)
+        error_counts = np.fromiter(
+            (len(t.get("error_codes", [])) if isinstance(t.get("error_codes", []), list) else 0 for t in telemetry_rows),
+            dtype=np.float64,
+            count=len(telemetry_rows),
+        )
+        total_risk = total_risk + np.minimum(0.3, error_counts * 0.15)
         
-        # Combine risk factors - use weighted sum with cap at 1.0
-        # Ensure minimum risk if health is low
-        total_risk = min(1.0, sum(risk_factors))
+        # Anomaly detection flag, from telemetry or the shared anomaly model
+        anomalies = np.fromiter(
+            (bool(t.get("anomaly_detected", False)) for t in telemetry_rows),
+            dtype=bool,
+            count=len(telemetry_rows),
+        )
+        if model_anomalies is not None:
+            anomalies |= model_anomalies
+        total_risk = total_risk + np.where(anomalies, 0.2, 0.0)
         
-        # If health is very low (< 60), ensure minimum risk of 0.4
-        if health is not None and health < 60:
-            total_risk = max(0.4, total_risk)
+        # Combine risk factors with cap at 1.0
+        total_risk = np.minimum(1.0, total_risk)
         
-        # If health is extremely low (< 40), ensure minimum risk of 0.7
-        if health is not None and health < 40:
-            total_risk = max(0.7, total_risk)
+        # Ensure minimum risk of 0.4 if health < 60 and 0.7 if health < 40
+        total_risk = np.where(health < 60, np.maximum(0.4, total_risk), total_risk)
+        total_risk = np.where(health < 40, np.maximum(0.7, total_risk), total_risk)
         
-        return round(total_risk, 3)
+        return total_risk
     
     def _get_recommendation(self, risk_score: float, telemetry: Dict[str, Any]) -> str:
         """Get recommendation based on risk score"""
-        if risk_score > 0.7:
-            return "High risk detected. Immediate service recommended within 3-5 days."
-        elif risk_score > 0.5:
-            return "Moderate risk detected. Schedule service within 7-10 days."
-        elif risk_score > 0.3:
-            return "Low risk detected. Schedule preventive maintenance within 14-21 days."
-        else:
-            return "Vehicle is in good condition. Regular maintenance recommended."
+        return _risk_band(risk_score)[1]
 
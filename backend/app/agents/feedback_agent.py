@@ -1,13 +1,17 @@
+import asyncio
 from typing import Dict, Any
-from datetime import datetime
+from datetime import datetime, timezone
 from app.agents.base_agent import BaseAgent
 from app.core.database import get_database
+from app.core.mongo_cache import invalidate_service_centers
 from app.models.customer import Feedback
-import uuid
+from app.utils.ids import short_id
 
 class FeedbackAgent(BaseAgent):
     """Tracks service completion and customer feedback"""
     
+    __slots__ = ()
+    
     def __init__(self):
         super().__init__("FeedbackAgent")
     
@@ -33,8 +37,10 @@ class FeedbackAgent(BaseAgent):
         
         db = get_database()
         
+        now = datetime.now(timezone.utc)
+        
         # Create feedback record
-        feedback_id = f"FB_{uuid.uuid4().hex[:8].upper()}"
+        feedback_id = f"FB_{short_id()}"
         feedback = Feedback(
             feedback_id=feedback_id,
             appointment_id=appointment_id,
@@ -43,31 +49,43 @@ class FeedbackAgent(BaseAgent):
             rating=rating,
             comments=comments,
             service_satisfaction=service_satisfaction,
-            issues_resolved=issues_resolved
+            issues_resolved=issues_resolved,
+            created_at=now
         )
         
-        await db.feedbacks.insert_one(feedback.dict(by_alias=True))
-        
-        # Update appointment status and loads ONLY if not already completed
-        appointment = await db.service_appointments.find_one({"appointment_id": appointment_id})
-        if appointment and appointment.get("status") != "completed":
-            await db.service_appointments.update_one(
+        # Store feedback while fetching the appointment it refers to
+        _, appointment = await asyncio.gather(
+            db.feedbacks.insert_one(feedback.model_dump(by_alias=True)),
+            db.service_appointments.find_one(
                 {"appointment_id": appointment_id},
-                {"$set": {"status": "completed", "updated_at": datetime.utcnow()}}
-            )
-            
-            # Update service center load
-            await db.service_centers.update_one(
-                {"center_id": appointment["service_center_id"]},
-                {"$inc": {"current_load": -1}}
+                {"_id": 0, "status": 1, "service_center_id": 1, "technician_id": 1}
             )
+        )
+        
+        # Update appointment status and loads ONLY if not already completed.
+        # The three updates touch different collections and run concurrently.
+        if appointment and appointment.get("status") != "completed":
+            updates = [
+                db.service_appointments.update_one(
+                    {"appointment_id": appointment_id},
+                    {"$set": {"status": "completed", "updated_at": now}}
+                ),
+                # Update service center load
+                db.service_centers.update_one(
+                    {"center_id": appointment["service_center_id"]},
+                    {"$inc": {"current_load": -1}}
+                ),
+            ]
             
             # Update technician assignments
             if appointment.get("technician_id"):
-                await db.technicians.update_one(
+                updates.append(db.technicians.update_one(
                     {"technician_id": appointment["technician_id"]},
-                    {"$inc": {"current_assignments": -1}}
-                )
+                    {"$inc": {"current_assignments": -1, "available_slots": 1}}
+                ))
+            
+            await asyncio.gather(*updates)
+            invalidate_service_centers()
         
         return {
             "status": "success",
@@ -81,41 +99,53 @@ class FeedbackAgent(BaseAgent):
         vin = input_data.get("vin")
         service_center_id = input_data.get("service_center_id")
         
-        query = {}
+        pipeline = []
         if vin:
-            query["vin"] = vin
+            pipeline.append({"$match": {"vin": vin}})
         if service_center_id:
-            # Get appointments for this service center
-            appointments = await db.service_appointments.find(
-                {"service_center_id": service_center_id}
-            ).to_list(1000)
-            appointment_ids = [apt["appointment_id"] for apt in appointments]
-            query["appointment_id"] = {"$in": appointment_ids}
+            # Join each feedback to its appointment to filter by service center
+            pipeline += [
+                {"$lookup": {
+                    "from": "service_appointments",
+                    "localField": "appointment_id",
+                    "foreignField": "appointment_id",
+                    "as": "appointment"
+                }},
+                {"$match": {"appointment.service_center_id": service_center_id}},
+            ]
         
-        feedbacks = await db.feedbacks.find(query).to_list(1000)
+        # One row per satisfaction level; totals are combined below
+        pipeline.append({"$group": {
+            "_id": {"$ifNull": ["$service_satisfaction", "unknown"]},
+            "count": {"$sum": 1},
+            "rating_sum": {"$sum": "$rating"},
+            "resolved": {"$sum": {"$cond": ["$issues_resolved", 1, 0]}}
+        }})
         
-        if not feedbacks:
-            return {"status": "success", "summary": {}, "count": 0}
+        groups = await db.feedbacks.aggregate(pipeline).to_list(None)
         
-        total_rating = sum(f.get("rating", 0) for f in feedbacks)
-        avg_rating = total_rating / len(feedbacks)
+        # Combine the per-level rows in a single pass
+        total = total_rating = resolved_count = 0
+        satisfaction_counts = {}
+        for g in groups:
+            total += g["count"]
+            total_rating += g["rating_sum"]
+            resolved_count += g["resolved"]
+            satisfaction_counts[g["_id"]] = g["count"]
         
-        resolved_count = sum(1 for f in feedbacks if f.get("issues_resolved", False))
-        resolution_rate = resolved_count / len(feedbacks) * 100
+        if not total:
+            return {"status": "success", "summary": {}, "count": 0}
         
-        satisfaction_counts = {}
-        for f in feedbacks:
-            sat = f.get("service_satisfaction", "unknown")
-            satisfaction_counts[sat] = satisfaction_counts.get(sat, 0) + 1
+        avg_rating = total_rating / total
+        resolution_rate = resolved_count / total * 100
         
         return {
             "status": "success",
             "summary": {
-                "total_feedbacks": len(feedbacks),
+                "total_feedbacks": total,
                 "average_rating": round(avg_rating, 2),
                 "resolution_rate": round(resolution_rate, 2),
                 "satisfaction_distribution": satisfaction_counts
             },
-            "count": len(feedbacks)
+            "count": total
         }
-
@@ -1,14 +1,146 @@
-from typing import Dict, Any, List
+import bisect
+import hashlib
+from typing import Dict, Any, FrozenSet, List, Optional, Set, Tuple
 from datetime import datetime, timedelta
 from collections import Counter
+import orjson
+from cachetools import LRUCache
+from pymongo import UpdateOne
 from app.agents.base_agent import BaseAgent
 from app.core.database import get_database
+from app.core.mongo_cache import get_vehicle
 from app.models.manufacturing import FailurePattern, RCACAPAInsight, RCACAPAAction
-import uuid
+from app.utils.ids import short_id
+
+# (component keyword, failure type keyword, root causes, cause tags) - the first
+# rule whose keyword appears in the lowercased component (or failure type) applies.
+# Tags name the failure mechanisms the causes describe and drive corrective actions.
+COMPONENT_ROOT_CAUSES: Tuple[Tuple[str, Optional[str], Tuple[str, ...], FrozenSet[str]], ...] = (
+    ("engine", None, (
+        "Insufficient lubrication leading to excessive wear",
+        "Overheating due to cooling system inefficiency",
+    ), frozenset({"lubrication", "overheating"})),
+    ("battery", None, (
+        "Battery degradation over time",
+        "Electrical system overload",
+    ), frozenset()),
+    ("oil", "pressure", (
+        "Oil degradation and contamination",
+        "Inadequate maintenance intervals",
+    ), frozenset()),
+)
+
+# Additional (root cause, cause tags) per known error code
+ERROR_CODE_ROOT_CAUSES: Dict[str, Tuple[str, FrozenSet[str]]] = {
+    "P0217": ("Thermostat malfunction causing overheating", frozenset({"overheating"})),
+    "P0521": ("Oil pump inefficiency or blockage", frozenset()),
+}
+
+# Contributing factors are currently the same for every pattern
+CONTRIBUTING_FACTORS: Tuple[str, ...] = (
+    "Environmental conditions (temperature extremes)",
+    "Driving patterns and usage intensity",
+    "Maintenance schedule adherence",
+    "Component manufacturing variations",
+)
+
+# Known diagnostic trouble codes -> failure type / affected component
+ERROR_CODE_FAILURE_TYPES: Dict[str, str] = {
+    "P0217": "Engine Overheating",
+    "P0521": "Oil Pressure Low",
+    "P0300": "Engine Misfire",
+    "P0420": "Catalyst Efficiency",
+}
+ERROR_CODE_COMPONENTS: Dict[str, str] = {
+    "P0217": "Engine Cooling System",
+    "P0521": "Engine Oil System",
+    "P0300": "Engine Ignition System",
+    "P0420": "Exhaust System",
+}
+
+# Impact label by occurrence count; a count equal to a threshold stays in the lower band
+IMPACT_THRESHOLDS = (20, 50)
+IMPACT_LABELS = (
+    "Low impact - limited occurrences but requires monitoring",
+    "Medium impact - affects multiple vehicles",
+    "High impact - affects significant number of vehicles",
+)
+
+# Pattern fields read when building an insight
+INSIGHT_PATTERN_PROJECTION = {
+    "_id": 0, "pattern_id": 1, "component": 1, "failure_type": 1, "error_codes": 1,
+    "occurrence_count": 1, "severity": 1, "manufacturer": 1,
+}
+
+# Insight fields fixed when the insight is first created; everything else is
+# derived from the pattern and rewritten only when its content hash changes
+INSIGHT_CREATE_ONLY_FIELDS = ("insight_id", "created_at", "status", "manufacturing_team_notified")
+
+
+# Derived insight content and its hash per pattern state. Derivation is pure, so
+# re-running generation over unchanged patterns reuses the previous result.
+INSIGHT_CONTENT_CACHE_MAXSIZE = 4096
+_insight_content_cache: LRUCache = LRUCache(maxsize=INSIGHT_CONTENT_CACHE_MAXSIZE)
+
+
+def _insight_content_hash(content: Dict[str, Any]) -> str:
+    """Stable hash of an insight's derived content"""
+    canonical = orjson.dumps(content, option=orjson.OPT_SORT_KEYS | orjson.OPT_NAIVE_UTC)
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+# CAPA action templates. Actions are never mutated after being attached to an
+# insight, so the same validated instances are shared instead of rebuilt per pattern.
+LUBRICATION_ACTION = RCACAPAAction(
+    action_type="corrective",
+    description="Review and update lubrication specifications",
+    priority="high",
+    responsible_team="Engineering",
+    status="pending"
+)
+COOLING_ACTION = RCACAPAAction(
+    action_type="corrective",
+    description="Enhance cooling system design",
+    priority="high",
+    responsible_team="Design",
+    status="pending"
+)
+QUALITY_CONTROL_ACTION = RCACAPAAction(
+    action_type="corrective",
+    description="Implement improved quality control measures",
+    priority="medium",
+    responsible_team="Quality",
+    status="pending"
+)
+PREVENTIVE_ACTIONS: Tuple[RCACAPAAction, ...] = (
+    RCACAPAAction(
+        action_type="preventive",
+        description="Enhance predictive maintenance algorithms",
+        priority="medium",
+        responsible_team="Data Science",
+        status="pending"
+    ),
+    RCACAPAAction(
+        action_type="preventive",
+        description="Develop early warning indicators for field monitoring",
+        priority="medium",
+        responsible_team="IoT Engineering",
+        status="pending"
+    ),
+    RCACAPAAction(
+        action_type="preventive",
+        description="Update service guidelines and customer communication",
+        priority="low",
+        responsible_team="After-sales",
+        status="pending"
+    ),
+)
 
 class ManufacturingInsightsAgent(BaseAgent):
     """Generates RCA/CAPA insights for manufacturing teams"""
     
+    __slots__ = ()
+    
     def __init__(self):
         super().__init__("ManufacturingInsightsAgent")
     
@@ -35,15 +167,34 @@ class ManufacturingInsightsAgent(BaseAgent):
         if manufacturer:
             query["manufacturer"] = manufacturer
         
-        patterns = await db.failure_patterns.find(query).to_list(100)
+        # Most frequent patterns first
+        patterns = await db.failure_patterns.find(query, INSIGHT_PATTERN_PROJECTION).sort(
+            "occurrence_count", -1
+        ).limit(100).to_list(100)
         
         if not patterns:
             return {"status": "success", "insights": [], "message": "No patterns requiring analysis"}
         
+        # Existing insights for all of these patterns in one query, indexed by
+        # pattern as the cursor batches arrive
+        existing_cursor = db.rcacapa_insights.find(
+            {"failure_pattern_id": {"$in": [pattern["pattern_id"] for pattern in patterns]}},
+            {"_id": 0}
+        )
+        existing_insights = {insight["failure_pattern_id"]: insight async for insight in existing_cursor}
+        
+        # Decide every insight locally, then store all changes in a single bulk write
+        now = datetime.utcnow()
         insights = []
+        operations = []
         for pattern in patterns:
-            insight = await self._create_insight(pattern)
+            insight, operation = self._plan_insight(pattern, existing_insights.get(pattern["pattern_id"]), now)
             insights.append(insight)
+            if operation:
+                operations.append(operation)
+        
+        if operations:
+            await db.rcacapa_insights.bulk_write(operations, ordered=False)
         
         return {
             "status": "success",
@@ -51,16 +202,49 @@ class ManufacturingInsightsAgent(BaseAgent):
             "count": len(insights)
         }
     
-    async def _create_insight(self, pattern: Dict[str, Any]) -> Dict[str, Any]:
-        """Create RCA/CAPA insight from failure pattern"""
-        db = get_database()
-        
+    def _plan_insight(
+        self,
+        pattern: Dict[str, Any],
+        existing: Optional[Dict[str, Any]],
+        now: datetime
+    ) -> Tuple[Dict[str, Any], Optional[UpdateOne]]:
+        """Return the insight for a pattern and the write needed to store it, if any"""
         pattern_id = pattern["pattern_id"]
         
-        # Check if insight already exists
-        existing = await db.rcacapa_insights.find_one({"failure_pattern_id": pattern_id})
-        if existing and existing.get("status") != "new":
-            return existing
+        # Insights that have moved past "new" are never regenerated
+        if existing and existing.get("status", "new") != "new":
+            return existing, None
+        
+        content, content_hash = self._derive_insight_content(pattern, now)
+        
+        if existing is None:
+            insight = {
+                **content,
+                "insight_id": f"INSIGHT_{short_id()}",
+                "created_at": now,
+                "status": "new",
+                "manufacturing_team_notified": False,
+                "content_hash": content_hash,
+                "updated_at": now,
+            }
+            # Insert-only, so an insight created concurrently is left untouched
+            return insight, UpdateOne({"failure_pattern_id": pattern_id}, {"$setOnInsert": insight}, upsert=True)
+        
+        if existing.get("content_hash") == content_hash:
+            return existing, None
+        
+        update = {**content, "content_hash": content_hash, "updated_at": now}
+        return {**existing, **update}, UpdateOne(
+            {
+                "failure_pattern_id": pattern_id,
+                "$or": [{"status": "new"}, {"status": {"$exists": False}}]
+            },
+            {"$set": update}
+        )
+    
+    def _derive_insight_content(self, pattern: Dict[str, Any], now: datetime) -> Tuple[Dict[str, Any], str]:
+        """Derive an RCA/CAPA insight's content from a failure pattern, with its content hash"""
+        pattern_id = pattern["pattern_id"]
         
         # Analyze pattern to generate insights
         component = pattern.get("component", "Unknown")
@@ -68,23 +252,28 @@ class ManufacturingInsightsAgent(BaseAgent):
         error_codes = pattern.get("error_codes", [])
         occurrence_count = pattern.get("occurrence_count", 0)
         severity = pattern.get("severity", "medium")
+        manufacturer = pattern.get("manufacturer", "Unknown")
+        
+        # Callers only copy the cached content, never mutate it
+        cache_key = (pattern_id, manufacturer, component, failure_type, tuple(error_codes), occurrence_count, severity)
+        cached = _insight_content_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
         # Generate root causes based on pattern
-        root_causes = self._identify_root_causes(component, failure_type, error_codes)
+        root_causes, cause_tags = self._identify_root_causes(component, failure_type, error_codes)
         
         # Generate corrective actions
-        corrective_actions = self._generate_corrective_actions(component, failure_type, root_causes)
+        corrective_actions = self._generate_corrective_actions(component, failure_type, cause_tags)
         
         # Generate preventive actions
         preventive_actions = self._generate_preventive_actions(component, failure_type, root_causes)
         
-        # Create insight
-        insight_id = f"INSIGHT_{uuid.uuid4().hex[:8].upper()}"
-        
+        # Validate through the model; creation-time fields are set per insight by the caller
         insight = RCACAPAInsight(
-            insight_id=insight_id,
+            insight_id="",
             failure_pattern_id=pattern_id,
-            manufacturer=pattern.get("manufacturer", "Unknown"),
+            manufacturer=manufacturer,
             title=f"RCA/CAPA Analysis: {component} {failure_type}",
             root_causes=root_causes,
             contributing_factors=self._identify_contributing_factors(component, failure_type),
@@ -95,108 +284,63 @@ class ManufacturingInsightsAgent(BaseAgent):
             estimated_impact=self._estimate_impact(occurrence_count, severity),
             recommendation_priority=severity,
             manufacturing_team_notified=False,
-            status="new"
-        )
-        
-        # Upsert insight
-        await db.rcacapa_insights.update_one(
-            {"failure_pattern_id": pattern_id},
-            {"$set": insight.dict(by_alias=True)},
-            upsert=True
+            status="new",
+            created_at=now,
+            updated_at=now
         )
         
-        return insight.dict(by_alias=True)
+        # Let MongoDB assign _id; creation-time fields are kept out of the content
+        content = insight.dict(by_alias=True, exclude={"id", "updated_at", *INSIGHT_CREATE_ONLY_FIELDS})
+        derived = (content, _insight_content_hash(content))
+        _insight_content_cache[cache_key] = derived
+        return derived
     
-    def _identify_root_causes(self, component: str, failure_type: str, error_codes: List[str]) -> List[str]:
-        """Identify root causes based on component and failure type"""
+    def _identify_root_causes(
+        self, component: str, failure_type: str, error_codes: List[str]
+    ) -> Tuple[List[str], Set[str]]:
+        """Identify root causes based on component and failure type, with their cause tags"""
         causes = []
+        tags = set()
         
         # Component-specific root causes
-        if "engine" in component.lower():
-            causes.append("Insufficient lubrication leading to excessive wear")
-            causes.append("Overheating due to cooling system inefficiency")
-        elif "battery" in component.lower():
-            causes.append("Battery degradation over time")
-            causes.append("Electrical system overload")
-        elif "oil" in component.lower() or "pressure" in failure_type.lower():
-            causes.append("Oil degradation and contamination")
-            causes.append("Inadequate maintenance intervals")
+        component_lower = component.lower()
+        failure_type_lower = failure_type.lower()
+        for keyword, failure_keyword, rule_causes, rule_tags in COMPONENT_ROOT_CAUSES:
+            if keyword in component_lower or (failure_keyword and failure_keyword in failure_type_lower):
+                causes.extend(rule_causes)
+                tags |= rule_tags
+                break
         
         # Error code specific causes
-        if "P0217" in error_codes:
-            causes.append("Thermostat malfunction causing overheating")
-        if "P0521" in error_codes:
-            causes.append("Oil pump inefficiency or blockage")
+        for code, (cause, cause_tags) in ERROR_CODE_ROOT_CAUSES.items():
+            if code in error_codes:
+                causes.append(cause)
+                tags |= cause_tags
         
-        return causes if causes else ["Root cause analysis pending detailed investigation"]
+        return (causes if causes else ["Root cause analysis pending detailed investigation"]), tags
     
-    def _identify_contributing_factors(self, component: str, failure_type: str) -> List[str]:
+    def _identify_contributing_factors(self, component: str, failure_type: str) -> Tuple[str, ...]:
         """Identify contributing factors"""
-        return [
-            "Environmental conditions (temperature extremes)",
-            "Driving patterns and usage intensity",
-            "Maintenance schedule adherence",
-            "Component manufacturing variations"
-        ]
+        # RCACAPAInsight validates this into its own list, so the constant is never mutated
+        return CONTRIBUTING_FACTORS
     
-    def _generate_corrective_actions(self, component: str, failure_type: str, root_causes: List[str]) -> List[RCACAPAAction]:
+    def _generate_corrective_actions(self, component: str, failure_type: str, cause_tags: Set[str]) -> List[RCACAPAAction]:
         """Generate corrective actions"""
         actions = []
         
-        if "lubrication" in " ".join(root_causes).lower():
-            actions.append(RCACAPAAction(
-                action_type="corrective",
-                description="Review and update lubrication specifications",
-                priority="high",
-                responsible_team="Engineering",
-                status="pending"
-            ))
+        if "lubrication" in cause_tags:
+            actions.append(LUBRICATION_ACTION)
         
-        if "overheating" in " ".join(root_causes).lower():
-            actions.append(RCACAPAAction(
-                action_type="corrective",
-                description="Enhance cooling system design",
-                priority="high",
-                responsible_team="Design",
-                status="pending"
-            ))
+        if "overheating" in cause_tags:
+            actions.append(COOLING_ACTION)
         
-        actions.append(RCACAPAAction(
-            action_type="corrective",
-            description="Implement improved quality control measures",
-            priority="medium",
-            responsible_team="Quality",
-            status="pending"
-        ))
+        actions.append(QUALITY_CONTROL_ACTION)
         
         return actions
     
     def _generate_preventive_actions(self, component: str, failure_type: str, root_causes: List[str]) -> List[RCACAPAAction]:
         """Generate preventive actions"""
-        actions = [
-            RCACAPAAction(
-                action_type="preventive",
-                description="Enhance predictive maintenance algorithms",
-                priority="medium",
-                responsible_team="Data Science",
-                status="pending"
-            ),
-            RCACAPAAction(
-                action_type="preventive",
-                description="Develop early warning indicators for field monitoring",
-                priority="medium",
-                responsible_team="IoT Engineering",
-                status="pending"
-            ),
-            RCACAPAAction(
-                action_type="preventive",
-                description="Update service guidelines and customer communication",
-                priority="low",
-                responsible_team="After-sales",
-                status="pending"
-            )
-        ]
-        return actions
+        return list(PREVENTIVE_ACTIONS)
     
     def _generate_analysis_summary(self, pattern: Dict[str, Any]) -> str:
         """Generate analysis summary"""
@@ -204,12 +348,7 @@ class ManufacturingInsightsAgent(BaseAgent):
     
     def _estimate_impact(self, occurrence_count: int, severity: str) -> str:
         """Estimate impact"""
-        if occurrence_count > 50:
-            return "High impact - affects significant number of vehicles"
-        elif occurrence_count > 20:
-            return "Medium impact - affects multiple vehicles"
-        else:
-            return "Low impact - limited occurrences but requires monitoring"
+        return IMPACT_LABELS[bisect.bisect_left(IMPACT_THRESHOLDS, occurrence_count)]
     
     async def _get_failure_patterns(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
         """Get failure patterns"""
@@ -220,7 +359,7 @@ class ManufacturingInsightsAgent(BaseAgent):
         if manufacturer:
             query["manufacturer"] = manufacturer
         
-        patterns = await db.failure_patterns.find(query).sort("occurrence_count", -1).to_list(100)
+        patterns = await db.failure_patterns.find(query, {"_id": 0}).sort("occurrence_count", -1).to_list(100)
         
         return {
             "status": "success",
@@ -233,23 +372,23 @@ class ManufacturingInsightsAgent(BaseAgent):
         db = get_database()
         
         # Get vehicle info
-        vehicle = await db.vehicles.find_one({"vin": vin})
+        vehicle = await get_vehicle(vin)
         if not vehicle:
             return
         
         manufacturer = vehicle.get("manufacturer")
         model = vehicle.get("model")
         
-        # Update patterns for each error code
+        # Build one upsert per error code and send them in a single round trip
+        now = datetime.utcnow()
+        operations = []
         for error_code in error_codes:
-            pattern_key = f"{manufacturer}_{model}_{error_code}"
-            
             # Determine failure type and component from error code
             failure_type = self._map_error_to_failure_type(error_code)
             component = component or self._map_error_to_component(error_code)
             
             # Update or create pattern
-            await db.failure_patterns.update_one(
+            operations.append(UpdateOne(
                 {
                     "manufacturer": manufacturer,
                     "model": model,
@@ -258,43 +397,36 @@ class ManufacturingInsightsAgent(BaseAgent):
                 },
                 {
                     "$setOnInsert": {
-                        "pattern_id": f"PAT_{uuid.uuid4().hex[:8].upper()}",
+                        "pattern_id": f"PAT_{short_id()}",
                         "failure_type": failure_type,
                         "component": component,
                         "manufacturer": manufacturer,
                         "model": model,
                         "error_codes": [error_code],
                         "occurrence_count": 0,
-                        "first_seen": datetime.utcnow(),
+                        "first_seen": now,
                         "severity": "medium",
-                        "created_at": datetime.utcnow()
+                        "created_at": now
                     },
                     "$inc": {"occurrence_count": 1},
                     "$set": {
-                        "last_seen": datetime.utcnow(),
-                        "updated_at": datetime.utcnow()
+                        "last_seen": now,
+                        "updated_at": now
                     }
                 },
                 upsert=True
-            )
+            ))
+        
+        if operations:
+            await db.failure_patterns.bulk_write(operations, ordered=False)
     
-    def _map_error_to_failure_type(self, error_code: str) -> str:
+    @staticmethod
+    def _map_error_to_failure_type(error_code: str) -> str:
         """Map error code to failure type"""
-        mapping = {
-            "P0217": "Engine Overheating",
-            "P0521": "Oil Pressure Low",
-            "P0300": "Engine Misfire",
-            "P0420": "Catalyst Efficiency",
-        }
-        return mapping.get(error_code, "General Failure")
+        return ERROR_CODE_FAILURE_TYPES.get(error_code, "General Failure")
     
-    def _map_error_to_component(self, error_code: str) -> str:
+    @staticmethod
+    def _map_error_to_component(error_code: str) -> str:
         """Map error code to component"""
-        mapping = {
-            "P0217": "Engine Cooling System",
-            "P0521": "Engine Oil System",
-            "P0300": "Engine Ignition System",
-            "P0420": "Exhaust System",
-        }
-        return mapping.get(error_code, "Unknown Component")
+        return ERROR_CODE_COMPONENTS.get(error_code, "Unknown Component")
 
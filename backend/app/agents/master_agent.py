@@ -1,3 +1,4 @@
+import asyncio
 from typing import Dict, Any, Optional
 from datetime import datetime
 from app.agents.base_agent import BaseAgent
@@ -10,19 +11,39 @@ from app.agents.manufacturing_insights_agent import ManufacturingInsightsAgent
 from app.agents.ueba_security_agent import UEBASecurityAgent
 from app.utils.logger import log_agent_action
 
+# Worker agents are stateless apart from the UEBA model, so every MasterAgent
+# shares one instance of each (and the UEBA detector stays fitted across them)
+_TELEMETRY_AGENT = TelemetryAgent()
+_FAILURE_PREDICTION_AGENT = FailurePredictionAgent()
+_CUSTOMER_ENGAGEMENT_AGENT = CustomerEngagementAgent()
+_SMART_SCHEDULING_AGENT = SmartSchedulingAgent()
+_FEEDBACK_AGENT = FeedbackAgent()
+_MANUFACTURING_INSIGHTS_AGENT = ManufacturingInsightsAgent()
+_UEBA_SECURITY_AGENT = UEBASecurityAgent()
+
 class MasterAgent(BaseAgent):
     """Master Agent orchestrates all worker agents"""
     
+    __slots__ = (
+        "telemetry_agent",
+        "failure_prediction_agent",
+        "customer_engagement_agent",
+        "smart_scheduling_agent",
+        "feedback_agent",
+        "manufacturing_insights_agent",
+        "ueba_security_agent",
+    )
+    
     def __init__(self):
         super().__init__("MasterAgent")
         # Initialize worker agents
-        self.telemetry_agent = TelemetryAgent()
-        self.failure_prediction_agent = FailurePredictionAgent()
-        self.customer_engagement_agent = CustomerEngagementAgent()
-        self.smart_scheduling_agent = SmartSchedulingAgent()
-        self.feedback_agent = FeedbackAgent()
-        self.manufacturing_insights_agent = ManufacturingInsightsAgent()
-        self.ueba_security_agent = UEBASecurityAgent()
+        self.telemetry_agent = _TELEMETRY_AGENT
+        self.failure_prediction_agent = _FAILURE_PREDICTION_AGENT
+        self.customer_engagement_agent = _CUSTOMER_ENGAGEMENT_AGENT
+        self.smart_scheduling_agent = _SMART_SCHEDULING_AGENT
+        self.feedback_agent = _FEEDBACK_AGENT
+        self.manufacturing_insights_agent = _MANUFACTURING_INSIGHTS_AGENT
+        self.ueba_security_agent = _UEBA_SECURITY_AGENT
     
     async def _execute(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -43,7 +64,7 @@ class MasterAgent(BaseAgent):
         
         results = {
             "workflow": workflow,
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.utcnow(),
             "steps": []
         }
         
@@ -55,40 +76,48 @@ class MasterAgent(BaseAgent):
                 telemetry_data = telemetry_result.get("telemetry", {})
                 vin = vin or telemetry_data.get("vin")
                 
-                # Step 2: Predict failures
-                prediction_result = await self.failure_prediction_agent.execute({"vin": vin})
-                results["steps"].append({"step": "failure_prediction", "result": prediction_result})
-                risk_score = prediction_result.get("risk_score", 0.0)
+                # Step 5 only needs the telemetry error codes, so update failure
+                # patterns for manufacturing in the background while steps 2-4 run
+                pattern_task = None
+                if telemetry_data.get("error_codes"):
+                    pattern_task = asyncio.create_task(
+                        self.manufacturing_insights_agent._update_failure_patterns(
+                            vin, telemetry_data.get("error_codes", [])
+                        )
+                    )
                 
-                # Step 3: Engage customer if risk detected
-                if risk_score > 0.3:
-                    if customer_id:
-                        engagement_result = await self.customer_engagement_agent.execute({
-                            "action": "send_alert",
-                            "vin": vin,
-                            "customer_id": customer_id,
-                            "risk_score": risk_score,
-                            "message_type": "prediction_alert"
-                        })
-                        results["steps"].append({"step": "customer_engagement", "result": engagement_result})
-                        
-                        # Step 4: Schedule service if high risk
-                        if risk_score > 0.5:
-                            schedule_result = await self.smart_scheduling_agent.execute({
-                                "action": "schedule",
-                                "customer_id": customer_id,
+                try:
+                    # Step 2: Predict failures
+                    prediction_result = await self.failure_prediction_agent.execute({"vin": vin})
+                    results["steps"].append({"step": "failure_prediction", "result": prediction_result})
+                    risk_score = prediction_result.get("risk_score", 0.0)
+                    
+                    # Step 3: Engage customer if risk detected
+                    if risk_score > 0.3:
+                        if customer_id:
+                            engagement_result = await self.customer_engagement_agent.execute({
+                                "action": "send_alert",
                                 "vin": vin,
-                                "service_type": "predictive",
-                                "priority": "high" if risk_score > 0.7 else "medium",
-                                "risk_score": risk_score
+                                "customer_id": customer_id,
+                                "risk_score": risk_score,
+                                "message_type": "prediction_alert"
                             })
-                            results["steps"].append({"step": "smart_scheduling", "result": schedule_result})
-                
-                # Step 5: Update failure patterns for manufacturing
-                if telemetry_data.get("error_codes"):
-                    await self.manufacturing_insights_agent._update_failure_patterns(
-                        vin, telemetry_data.get("error_codes", [])
-                    )
+                            results["steps"].append({"step": "customer_engagement", "result": engagement_result})
+                            
+                            # Step 4: Schedule service if high risk
+                            if risk_score > 0.5:
+                                schedule_result = await self.smart_scheduling_agent.execute({
+                                    "action": "schedule",
+                                    "customer_id": customer_id,
+                                    "vin": vin,
+                                    "service_type": "predictive",
+                                    "priority": "high" if risk_score > 0.7 else "medium",
+                                    "risk_score": risk_score
+                                })
+                                results["steps"].append({"step": "smart_scheduling", "result": schedule_result})
+                finally:
+                    if pattern_task:
+                        await pattern_task
             
             elif workflow == "collect_feedback":
                 feedback_result = await self.feedback_agent.execute(input_data)
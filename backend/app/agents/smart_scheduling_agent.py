@@ -1,13 +1,93 @@
-from typing import Dict, Any, List
+import asyncio
+import re
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Pattern, Tuple
 from datetime import datetime, timedelta, timezone
+from pymongo import ReturnDocument
 from app.agents.base_agent import BaseAgent
 from app.core.database import get_database
-from app.models.customer import ServiceAppointment
-import uuid
+from app.core.mongo_cache import get_active_service_centers, invalidate_service_centers
+from app.utils.ids import short_id
+
+_UTC = timezone.utc
+
+# Predicted issue keywords per technician specialization, in priority order -
+# the first category with a keyword contained in the issue text wins
+ISSUE_CATEGORY_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    "engine": ("engine", "overheating", "temperature", "cooling", "turbo", "oil", "lubrication"),
+    "electrical": ("electrical", "battery", "voltage", "charging", "wiring", "circuit"),
+    "brakes": ("brake", "braking", "brake pad", "brake disc"),
+    "suspension": ("suspension", "shock", "strut", "alignment"),
+    "transmission": ("transmission", "gearbox", "clutch", "shifting"),
+    "ac": ("ac", "air conditioning", "cooling system", "heating", "climate"),
+    "tires": ("tire", "tyre", "wheel", "tread"),
+    "steering": ("steering", "alignment", "wheel alignment"),
+}
+
+# One precompiled substring alternation per category, built once at import
+_ISSUE_CATEGORY_PATTERNS: List[Tuple[Pattern, str]] = [
+    (re.compile("|".join(re.escape(keyword) for keyword in keywords)), category.capitalize())
+    for category, keywords in ISSUE_CATEGORY_KEYWORDS.items()
+]
+
+URGENT_PRIORITIES = frozenset({"critical", "high"})
+
+# Scheduling only reads these fields back from centre and appointment documents
+CENTER_SLOT_PROJECTION = {"_id": 0, "center_id": 1, "name": 1, "status": 1, "capacity": 1, "current_load": 1}
+APPOINTMENT_RELEASE_PROJECTION = {
+    "_id": 0, "customer_id": 1, "vin": 1, "status": 1, "service_center_id": 1, "technician_id": 1,
+    "service_type": 1, "priority": 1, "failure_risk": 1,
+}
+
+
+@lru_cache(maxsize=2048)
+def extract_issue_category(predicted_issue: str) -> Optional[str]:
+    """Extract issue category from predicted issue text to match with technician specialization"""
+    if not predicted_issue:
+        return None
+    
+    issue_lower = predicted_issue.lower()
+    
+    # Check which category matches
+    for pattern, category in _ISSUE_CATEGORY_PATTERNS:
+        if pattern.search(issue_lower):
+            return category
+    
+    return None
+
+
+async def claim_technician(db, center_id: str, issue_category: Optional[str]) -> Optional[str]:
+    """Atomically take an assignment on the least-loaded available technician at a center,
+    specialists in issue_category first"""
+    available = {
+        "service_center_id": center_id,
+        "status": "available",
+        "available_slots": {"$gt": 0}
+    }
+    candidates = [available]
+    if issue_category:
+        candidates.insert(0, {**available, "specialization": {"$in": [issue_category]}})
+    
+    # Capacity check and increment happen in one operation, so concurrent
+    # bookings can't both take a technician's last slot. A single
+    # specialists-first aggregation can't also claim the technician, so the
+    # specialist and fallback claims stay separate.
+    for query in candidates:
+        technician = await db.technicians.find_one_and_update(
+            query,
+            {"$inc": {"current_assignments": 1, "available_slots": -1}},
+            sort=[("current_assignments", 1)],
+            projection={"_id": 0, "technician_id": 1}
+        )
+        if technician:
+            return technician["technician_id"]
+    return None
 
 class SmartSchedulingAgent(BaseAgent):
     """Smartly schedules service appointments based on availability"""
     
+    __slots__ = ()
+    
     def __init__(self):
         super().__init__("SmartSchedulingAgent")
     
@@ -35,151 +115,128 @@ class SmartSchedulingAgent(BaseAgent):
         risk_score = input_data.get("risk_score", 0.0)
         scheduled_date_str = input_data.get("scheduled_date")  # ISO format string from frontend
         
+        # Validate up front, before any capacity is claimed
+        if not customer_id or not vin:
+            return {"status": "error", "message": "Customer ID and VIN required"}
+        if not 0.0 <= risk_score <= 1.0:
+            return {"status": "error", "message": "Risk score must be between 0 and 1"}
+        
         # Determine priority based on risk
         if risk_score > 0.7:
             priority = "critical"
         elif risk_score > 0.5:
             priority = "high"
         
-        # Find available service center and slot
-        db = get_database()
-        
-        # Get service centers - use selected one if provided, otherwise find best
-        # Always fetch from MongoDB for live data
-        if service_center_id:
-            # First try to find by center_id and status
-            service_center = await db.service_centers.find_one({"center_id": service_center_id, "status": "active"})
-            
-            # If not found, try without status filter (might be inactive)
-            if not service_center:
-                service_center = await db.service_centers.find_one({"center_id": service_center_id})
-                if service_center:
-                    return {"status": "error", "message": f"Service center {service_center.get('name', service_center_id)} is currently inactive. Please select another center."}
-            
-            # If still not found, return error with available centers
-            if not service_center:
-                all_centers = await db.service_centers.find({"status": "active"}).to_list(100)
-                available_ids = [c.get("center_id") for c in all_centers]
-                return {
-                    "status": "error", 
-                    "message": f"Service center {service_center_id} not found. Available centers: {', '.join(available_ids) if available_ids else 'None'}"
-                }
-            
-            # Check if center has available capacity
-            capacity = service_center.get("capacity", 10)
-            current_load = service_center.get("current_load", 0)
-            available_slots = capacity - current_load
-            
-            if available_slots <= 0:
-                return {
-                    "status": "error", 
-                    "message": f"Service center {service_center.get('name')} is at full capacity ({current_load}/{capacity}). Please select another center."
-                }
-            
-            service_centers = [service_center]
-        else:
-            service_centers = await db.service_centers.find({"status": "active"}).to_list(100)
-        
-        if not service_centers:
-            return {"status": "error", "message": "No service centers available"}
-        
-        # Parse scheduled date if provided, otherwise find best slot
+        # Parse scheduled date if provided (before any capacity is taken)
+        scheduled_date = None
         if scheduled_date_str:
             try:
                 # Handle ISO format with or without timezone; normalize to UTC
                 if 'T' in scheduled_date_str:
                     scheduled_date = datetime.fromisoformat(scheduled_date_str.replace('Z', '+00:00'))
                     if scheduled_date.tzinfo is None:
-                        scheduled_date = scheduled_date.replace(tzinfo=timezone.utc)
+                        scheduled_date = scheduled_date.replace(tzinfo=_UTC)
                     else:
-                        scheduled_date = scheduled_date.astimezone(timezone.utc)
+                        scheduled_date = scheduled_date.astimezone(_UTC)
                 else:
                     # If only date provided, use default time (10:00 AM UTC)
                     scheduled_date = datetime.fromisoformat(scheduled_date_str)
-                    scheduled_date = scheduled_date.replace(hour=10, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
-                
-                # Ensure date is in the future (compare in UTC)
-                now_utc = datetime.now(timezone.utc)
-                if scheduled_date < now_utc:
-                    return {"status": "error", "message": "Scheduled date must be in the future"}
-                
-                center_id = service_centers[0]["center_id"]
-                # Get predicted issue to match with technician specialization
-                predicted_issue = input_data.get("predicted_issue", "")
-                issue_category = self._extract_issue_category(predicted_issue)
-                
-                # Find available technician matching specialization
-                technician_id = None
-                if issue_category:
-                    # First try to find technician with matching specialization
-                    matching_technicians = await db.technicians.find({
-                        "service_center_id": center_id,
-                        "status": "available",
-                        "specialization": {"$in": [issue_category]},
-                        "$expr": {"$lt": ["$current_assignments", "$max_capacity"]}
-                    }).to_list(100)
-                    
-                    if matching_technicians:
-                        # Select technician with least current assignments
-                        matching_technicians.sort(key=lambda x: x.get("current_assignments", 0))
-                        technician_id = matching_technicians[0]["technician_id"]
-                
-                # If no matching specialist found, find any available technician
-                if not technician_id:
-                    technicians = await db.technicians.find({
-                        "service_center_id": center_id,
-                        "status": "available",
-                        "$expr": {"$lt": ["$current_assignments", "$max_capacity"]}
-                    }).sort("current_assignments", 1).limit(1).to_list(1)
-                    
-                    if technicians:
-                        technician_id = technicians[0]["technician_id"]
-                
-                # Update technician assignments
+                    scheduled_date = scheduled_date.replace(hour=10, minute=0, second=0, microsecond=0, tzinfo=_UTC)
+            except Exception as e:
+                return {"status": "error", "message": f"Invalid date format: {str(e)}"}
+            
+            # Ensure date is in the future (compare in UTC)
+            now_utc = datetime.now(_UTC)
+            if scheduled_date < now_utc:
+                return {"status": "error", "message": "Scheduled date must be in the future"}
+        
+        # Find available service center and slot
+        db = get_database()
+        
+        # Get predicted issue to match with technician specialization
+        issue_category = extract_issue_category(input_data.get("predicted_issue", ""))
+        
+        # Take a slot at the selected center if provided, otherwise at the first
+        # active center with capacity. Always works on live MongoDB data.
+        if service_center_id:
+            # The center is known up front, so its slot and a technician are
+            # claimed concurrently; the technician is handed back if the center is full
+            service_center, technician_id = await asyncio.gather(
+                self._claim_center_slot(db, service_center_id),
+                claim_technician(db, service_center_id, issue_category)
+            )
+            if not service_center:
                 if technician_id:
                     await db.technicians.update_one(
                         {"technician_id": technician_id},
-                        {"$inc": {"current_assignments": 1}}
+                        {"$inc": {"current_assignments": -1, "available_slots": 1}}
                     )
+                # Work out why the slot could not be taken
+                service_center = await db.service_centers.find_one(
+                    {"center_id": service_center_id}, CENTER_SLOT_PROJECTION
+                )
+                if service_center and service_center.get("status") != "active":
+                    return {"status": "error", "message": f"Service center {service_center.get('name', service_center_id)} is currently inactive. Please select another center."}
+                if service_center:
+                    capacity = service_center.get("capacity", 10)
+                    current_load = service_center.get("current_load", 0)
+                    return {
+                        "status": "error", 
+                        "message": f"Service center {service_center.get('name')} is at full capacity ({current_load}/{capacity}). Please select another center."
+                    }
                 
-                description = f"{service_type.capitalize()} service for vehicle"
-            except Exception as e:
-                return {"status": "error", "message": f"Invalid date format: {str(e)}"}
+                # Not found - return error with available centers
+                all_centers = await get_active_service_centers()
+                available_ids = [c.get("center_id") for c in all_centers]
+                return {
+                    "status": "error", 
+                    "message": f"Service center {service_center_id} not found. Available centers: {', '.join(available_ids) if available_ids else 'None'}"
+                }
         else:
-            # Find best available slot if no date provided
-            appointment_details = await self._find_best_slot(
-                service_centers, priority, service_type, input_data.get("predicted_issue", "")
-            )
-            if not appointment_details:
+            service_centers = await get_active_service_centers()
+            if not service_centers:
+                return {"status": "error", "message": "No service centers available"}
+            
+            service_center = None
+            for center in service_centers:
+                if center.get("current_load", 0) < center.get("capacity", 10):
+                    service_center = await self._claim_center_slot(db, center["center_id"])
+                    if service_center:
+                        break
+            if not service_center:
                 return {"status": "error", "message": "No available slots"}
-            scheduled_date = appointment_details["scheduled_date"]
-            technician_id = appointment_details.get("technician_id")
-            center_id = appointment_details["center_id"]
-            description = appointment_details.get("description", "Predictive maintenance service")
+            
+            # Assign available technician, preferring a matching specialization
+            technician_id = await claim_technician(db, service_center["center_id"], issue_category)
         
-        # Create appointment
-        appointment_id = f"APT_{uuid.uuid4().hex[:8].upper()}"
-        appointment = ServiceAppointment(
-            appointment_id=appointment_id,
-            customer_id=customer_id,
-            vin=vin,
-            service_center_id=center_id,
-            technician_id=technician_id,
-            scheduled_date=scheduled_date,
-            service_type=service_type,
-            status="scheduled",
-            description=description,
-            failure_risk=risk_score,
-            priority=priority
-        )
+        center_id = service_center["center_id"]
         
-        await db.service_appointments.insert_one(appointment.dict(by_alias=True))
+        # Use the requested date, otherwise find best slot
+        if scheduled_date:
+            description = f"{service_type.capitalize()} service for vehicle"
+        else:
+            appointment_details = self._find_best_slot(service_center, priority, service_type)
+            scheduled_date = appointment_details["scheduled_date"]
+            description = appointment_details.get("description", "Predictive maintenance service")
         
-        # Update service center load
-        await db.service_centers.update_one(
-            {"center_id": center_id},
-            {"$inc": {"current_load": 1}}
-        )
+        # Create appointment (fields validated above, so no model round trip)
+        appointment_id = f"APT_{short_id()}"
+        created_at = datetime.now(_UTC)
+        await db.service_appointments.insert_one({
+            "appointment_id": appointment_id,
+            "customer_id": customer_id,
+            "vin": vin,
+            "service_center_id": center_id,
+            "technician_id": technician_id,
+            "scheduled_date": scheduled_date,
+            "service_type": service_type,
+            "status": "scheduled",
+            "description": description,
+            "failure_risk": risk_score,
+            "priority": priority,
+            "created_at": created_at,
+            "updated_at": created_at
+        })
         
         return {
             "status": "success",
@@ -190,76 +247,42 @@ class SmartSchedulingAgent(BaseAgent):
             "message": "Appointment scheduled successfully"
         }
     
-    async def _find_best_slot(self, service_centers: List[Dict], priority: str, service_type: str, predicted_issue: str = "") -> Dict[str, Any]:
-        """Find the best available appointment slot"""
-        db = get_database()
-        
+    async def _claim_center_slot(self, db, center_id: str) -> Optional[Dict[str, Any]]:
+        """Atomically take one slot at an active center with spare capacity; None if it has none"""
+        center = await db.service_centers.find_one_and_update(
+            {
+                "center_id": center_id,
+                "status": "active",
+                "$expr": {"$lt": [{"$ifNull": ["$current_load", 0]}, {"$ifNull": ["$capacity", 10]}]}
+            },
+            {"$inc": {"current_load": 1}},
+            projection=CENTER_SLOT_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+        if center:
+            invalidate_service_centers()
+        return center
+    
+    def _find_best_slot(self, center: Dict[str, Any], priority: str, service_type: str) -> Dict[str, Any]:
+        """Find the best available appointment slot at a center"""
         # For critical/high priority, try to schedule within 1-2 days
         # For medium/low, schedule within 1 week
-        if priority in ["critical", "high"]:
-            start_date = datetime.now(timezone.utc) + timedelta(days=1)
-            end_date = datetime.now(timezone.utc) + timedelta(days=2)
-        else:
-            start_date = datetime.now(timezone.utc) + timedelta(days=1)
-            end_date = datetime.now(timezone.utc) + timedelta(days=7)
+        now = datetime.now(_UTC)
+        start_date = now + timedelta(days=1)
+        end_date = now + timedelta(days=2 if priority in URGENT_PRIORITIES else 7)
         
-        # Get predicted issue to match with technician specialization
-        predicted_issue = input_data.get("predicted_issue", "")
-        issue_category = self._extract_issue_category(predicted_issue)
+        # Generate appointment time (business hours: 9 AM - 6 PM)
+        scheduled_date = start_date.replace(hour=10, minute=0, second=0, microsecond=0, tzinfo=_UTC)
         
-        # Find service center with available capacity
-        for center in service_centers:
-            if center.get("current_load", 0) < center.get("capacity", 10):
-                technician_id = None
-                
-                # First try to find technician with matching specialization
-                if issue_category:
-                    matching_technicians = await db.technicians.find({
-                        "service_center_id": center["center_id"],
-                        "status": "available",
-                        "specialization": {"$in": [issue_category]},
-                        "$expr": {"$lt": ["$current_assignments", "$max_capacity"]}
-                    }).to_list(100)
-                    
-                    if matching_technicians:
-                        # Select technician with least current assignments
-                        matching_technicians.sort(key=lambda x: x.get("current_assignments", 0))
-                        technician_id = matching_technicians[0]["technician_id"]
-                
-                # If no matching specialist found, find any available technician
-                if not technician_id:
-                    technicians = await db.technicians.find({
-                        "service_center_id": center["center_id"],
-                        "status": "available",
-                        "$expr": {"$lt": ["$current_assignments", "$max_capacity"]}
-                    }).sort("current_assignments", 1).limit(1).to_list(1)
-                    
-                    if technicians:
-                        technician_id = technicians[0]["technician_id"]
-                
-                # Update technician assignments
-                if technician_id:
-                    await db.technicians.update_one(
-                        {"technician_id": technician_id},
-                        {"$inc": {"current_assignments": 1}}
-                    )
-                
-                # Generate appointment time (business hours: 9 AM - 6 PM)
-                scheduled_date = start_date.replace(hour=10, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
-                
-                return {
-                    "center_id": center["center_id"],
-                    "technician_id": technician_id,
-                    "scheduled_date": scheduled_date,
-                    "description": f"{service_type.capitalize()} service for vehicle"
-                }
-        
-        return None
+        return {
+            "center_id": center["center_id"],
+            "scheduled_date": scheduled_date,
+            "description": f"{service_type.capitalize()} service for vehicle"
+        }
     
     async def _check_availability(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
         """Check service center availability - Fetches live data from MongoDB"""
-        db = get_database()
-        service_centers = await db.service_centers.find({"status": "active"}).to_list(100)
+        service_centers = await get_active_service_centers()
         
         availability = []
         for center in service_centers:
@@ -296,31 +319,18 @@ class SmartSchedulingAgent(BaseAgent):
         db = get_database()
         
         # Find the old appointment
-        old_appointment = await db.service_appointments.find_one({"appointment_id": appointment_id})
+        old_appointment = await db.service_appointments.find_one(
+            {"appointment_id": appointment_id}, APPOINTMENT_RELEASE_PROJECTION
+        )
         if not old_appointment:
             return {"status": "error", "message": "Appointment not found"}
         
-        # Cancel the old appointment
-        await db.service_appointments.update_one(
-            {"appointment_id": appointment_id},
-            {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}
-        )
-        
-        # Decrease service center load for old appointment
+        # Cancel the old appointment and release its center/technician capacity.
+        # The writes touch different documents, so they run concurrently; they
+        # complete before the new appointment is scheduled against that capacity.
         old_center_id = old_appointment.get("service_center_id")
-        if old_center_id:
-            await db.service_centers.update_one(
-                {"center_id": old_center_id},
-                {"$inc": {"current_load": -1}}
-            )
-        
-        # Decrease technician assignments for old appointment
         old_technician_id = old_appointment.get("technician_id")
-        if old_technician_id:
-            await db.technicians.update_one(
-                {"technician_id": old_technician_id},
-                {"$inc": {"current_assignments": -1}}
-            )
+        await self._release_appointment(db, appointment_id, old_center_id, old_technician_id)
         
         # Create new appointment with updated details
         # Use the same customer_id and vin from old appointment
@@ -352,7 +362,9 @@ class SmartSchedulingAgent(BaseAgent):
         db = get_database()
         
         # Find the appointment
-        appointment = await db.service_appointments.find_one({"appointment_id": appointment_id})
+        appointment = await db.service_appointments.find_one(
+            {"appointment_id": appointment_id}, APPOINTMENT_RELEASE_PROJECTION
+        )
         if not appointment:
             return {"status": "error", "message": "Appointment not found"}
         
@@ -360,57 +372,35 @@ class SmartSchedulingAgent(BaseAgent):
         if appointment.get("status") not in ["scheduled"]:
             return {"status": "error", "message": f"Cannot cancel appointment with status: {appointment.get('status')}"}
         
-        # Cancel the appointment
-        await db.service_appointments.update_one(
-            {"appointment_id": appointment_id},
-            {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}
+        # Cancel the appointment and decrease service center load / technician assignments
+        await self._release_appointment(
+            db, appointment_id, appointment.get("service_center_id"), appointment.get("technician_id")
         )
         
-        # Decrease service center load
-        center_id = appointment.get("service_center_id")
-        if center_id:
-            await db.service_centers.update_one(
-                {"center_id": center_id},
-                {"$inc": {"current_load": -1}}
-            )
-        
-        # Decrease technician assignments
-        technician_id = appointment.get("technician_id")
-        if technician_id:
-            await db.technicians.update_one(
-                {"technician_id": technician_id},
-                {"$inc": {"current_assignments": -1}}
-            )
-        
         return {
             "status": "success",
             "message": "Appointment cancelled successfully",
             "appointment_id": appointment_id
         }
     
-    def _extract_issue_category(self, predicted_issue: str) -> str:
-        """Extract issue category from predicted issue text to match with technician specialization"""
-        if not predicted_issue:
-            return None
-        
-        issue_lower = predicted_issue.lower()
-        
-        # Map predicted issues to technician specializations
-        category_mapping = {
-            "engine": ["engine", "overheating", "temperature", "cooling", "turbo", "oil", "lubrication"],
-            "electrical": ["electrical", "battery", "voltage", "charging", "wiring", "circuit"],
-            "brakes": ["brake", "braking", "brake pad", "brake disc"],
-            "suspension": ["suspension", "shock", "strut", "alignment"],
-            "transmission": ["transmission", "gearbox", "clutch", "shifting"],
-            "ac": ["ac", "air conditioning", "cooling system", "heating", "climate"],
-            "tires": ["tire", "tyre", "wheel", "tread"],
-            "steering": ["steering", "alignment", "wheel alignment"]
-        }
-        
-        # Check which category matches
-        for category, keywords in category_mapping.items():
-            if any(keyword in issue_lower for keyword in keywords):
-                return category.capitalize()
-        
-        return None
-
+    async def _release_appointment(
+        self, db, appointment_id: str, center_id: Optional[str], technician_id: Optional[str]
+    ) -> None:
+        """Mark an appointment cancelled and give back its center and technician capacity"""
+        writes = [db.service_appointments.update_one(
+            {"appointment_id": appointment_id},
+            {"$set": {"status": "cancelled", "updated_at": datetime.now(_UTC)}}
+        )]
+        if center_id:
+            writes.append(db.service_centers.update_one(
+                {"center_id": center_id},
+                {"$inc": {"current_load": -1}}
+            ))
+        if technician_id:
+            writes.append(db.technicians.update_one(
+                {"technician_id": technician_id},
+                {"$inc": {"current_assignments": -1, "available_slots": 1}}
+            ))
+        await asyncio.gather(*writes)
+        if center_id:
+            invalidate_service_centers()
@@ -1,34 +1,200 @@
+import asyncio
 import random
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+from pymongo.errors import BulkWriteError, WriteError
 from app.agents.base_agent import BaseAgent
 from app.core.database import get_database
-from app.models.vehicle import VehicleTelemetry
+from app.core.mongo_cache import invalidate_telemetry
+
+# Sensor columns: engine temperature, oil pressure, vibration, battery voltage
+TELEMETRY_BASELINE = np.array([85.0, 45.0, 2.5, 12.6])
+TELEMETRY_NOISE_LOW = np.array([-5.0, -5.0, -0.5, -0.5])
+TELEMETRY_NOISE_HIGH = np.array([10.0, 5.0, 0.5, 0.5])
+TELEMETRY_ANOMALY_LOW = np.array([95.0, 10.0, 5.0, 10.0])
+TELEMETRY_ANOMALY_HIGH = np.array([130.0, 25.0, 10.0, 11.5])
+# Health penalty per unit past each threshold; sign flips "below" checks to "above"
+HEALTH_PENALTY_SIGN = np.array([1.0, -1.0, 1.0, -1.0])
+HEALTH_PENALTY_THRESHOLDS = np.array([100.0, 30.0, 4.0, 12.0])
+HEALTH_PENALTY_WEIGHTS = np.array([2.0, 1.5, 5.0, 3.0])
+
+# Dedicated generator for single-sample simulation, with its methods bound once
+_rng = random.Random()
+_uniform = _rng.uniform
+_random = _rng.random
+
+# Single-sample ingests are group-committed: concurrent callers queue their
+# documents and one writer task stores everything queued so far with a single
+# insert_many. Each caller still waits for its own write, so telemetry is
+# readable as soon as execute() returns.
+TELEMETRY_BATCH_SIZE = 200
+TELEMETRY_QUEUE_MAXSIZE = 1000
+
+_telemetry_queue: asyncio.Queue = asyncio.Queue(maxsize=TELEMETRY_QUEUE_MAXSIZE)
+_telemetry_writer_task: Optional[asyncio.Task] = None
+
+
+# Queued after everything else by stop_telemetry_writer; the writer stores the
+# batch in hand and exits when it reaches it
+_STOP_WRITER = object()
+
+
+def _fail_waiters(batch: List[Tuple[Dict[str, Any], asyncio.Future]], error: BaseException) -> None:
+    for _, waiter in batch:
+        if not waiter.done():
+            waiter.set_exception(error)
+
+
+async def _write_telemetry_batch(batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+    try:
+        db = get_database()
+        await db.vehicle_telemetry.insert_many([doc for doc, _ in batch], ordered=False)
+    except BulkWriteError as e:
+        # Unordered inserts store every other document, so only the rejected
+        # ones fail their callers
+        failed = {error["index"]: error for error in e.details.get("writeErrors", [])}
+        for i, (_, waiter) in enumerate(batch):
+            if waiter.done():
+                continue
+            error = failed.get(i)
+            if error is not None:
+                waiter.set_exception(
+                    WriteError(error.get("errmsg", "Telemetry write failed"), error.get("code"), error)
+                )
+            else:
+                waiter.set_result(None)
+        return
+    except Exception as e:
+        _fail_waiters(batch, e)
+        return
+    except asyncio.CancelledError:
+        # Never leave callers waiting on a write that will not finish
+        _fail_waiters(batch, RuntimeError("Telemetry writer stopped before the write completed"))
+        raise
+    for _, waiter in batch:
+        if not waiter.done():
+            waiter.set_result(None)
+
+
+async def _drain_telemetry_queue() -> None:
+    """Write queued telemetry in batches of up to TELEMETRY_BATCH_SIZE until the stop sentinel"""
+    while True:
+        item = await _telemetry_queue.get()
+        batch = []
+        while item is not _STOP_WRITER:
+            batch.append(item)
+            if len(batch) >= TELEMETRY_BATCH_SIZE:
+                break
+            try:
+                item = _telemetry_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        if batch:
+            await _write_telemetry_batch(batch)
+        if item is _STOP_WRITER:
+            return
+
+
+def start_telemetry_writer() -> None:
+    """Start the background telemetry writer (idempotent)"""
+    global _telemetry_writer_task
+    if _telemetry_writer_task is None or _telemetry_writer_task.done():
+        _telemetry_writer_task = asyncio.create_task(_drain_telemetry_queue())
+
+
+async def stop_telemetry_writer() -> None:
+    """Stop the background writer once it has stored everything queued so far"""
+    global _telemetry_writer_task
+    if _telemetry_writer_task is not None:
+        if not _telemetry_writer_task.done():
+            await _telemetry_queue.put(_STOP_WRITER)
+            await _telemetry_writer_task
+        _telemetry_writer_task = None
+
+    # Samples queued by callers that raced the shutdown
+    while not _telemetry_queue.empty():
+        remaining = []
+        while len(remaining) < TELEMETRY_BATCH_SIZE and not _telemetry_queue.empty():
+            item = _telemetry_queue.get_nowait()
+            if item is not _STOP_WRITER:
+                remaining.append(item)
+        if remaining:
+            await _write_telemetry_batch(remaining)
+
+
+# VINs to simulate when a request names none; refreshed every few minutes
+VIN_POOL_SIZE = 500
+VIN_POOL_TTL_SECONDS = 300
+
+_vin_pool: List[str] = []
+
+# Upper bound on VINs simulated by one batch ingest request
+TELEMETRY_BATCH_MAX_VINS = 1000
+_vin_pool_expires_at = 0.0
+
+
+async def _get_vin_pool() -> List[str]:
+    """Get a cached sample of known vehicle VINs"""
+    global _vin_pool, _vin_pool_expires_at
+    if time.monotonic() >= _vin_pool_expires_at:
+        db = get_database()
+        vehicles = await db.vehicles.find({}, {"_id": 0, "vin": 1}).limit(VIN_POOL_SIZE).to_list(VIN_POOL_SIZE)
+        _vin_pool = [v["vin"] for v in vehicles if v.get("vin")]
+        # Don't hold on to an empty pool; vehicles may be registered any moment
+        if _vin_pool:
+            _vin_pool_expires_at = time.monotonic() + VIN_POOL_TTL_SECONDS
+    return _vin_pool
+
+
+async def _store_telemetry(doc: Dict[str, Any]) -> None:
+    """Store a telemetry document through the batched writer when it is running"""
+    if _telemetry_writer_task is None or _telemetry_writer_task.done():
+        db = get_database()
+        await db.vehicle_telemetry.insert_one(doc)
+        return
+    waiter = asyncio.get_running_loop().create_future()
+    await _telemetry_queue.put((doc, waiter))
+    await waiter
 
 class TelemetryAgent(BaseAgent):
     """Ingests and processes simulated vehicle telemetry data"""
     
+    __slots__ = ()
+    
     def __init__(self):
         super().__init__("TelemetryAgent")
     
     async def _execute(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
+        vins = input_data.get("vins")
+        if vins is not None:
+            if (
+                not isinstance(vins, list)
+                or not 0 < len(vins) <= TELEMETRY_BATCH_MAX_VINS
+                or not all(isinstance(v, str) and v for v in vins)
+            ):
+                return {
+                    "status": "error",
+                    "message": f"vins must be a list of 1-{TELEMETRY_BATCH_MAX_VINS} non-empty VIN strings"
+                }
+            return await self._ingest_batch(vins)
+        
         vin = input_data.get("vin")
         if not vin:
             # Simulate data for a random vehicle if VIN not provided
-            db = get_database()
-            vehicles = await db.vehicles.find({}).limit(1).to_list(1)
-            if vehicles:
-                vin = vehicles[0]["vin"]
+            vin_pool = await _get_vin_pool()
+            if vin_pool:
+                vin = random.choice(vin_pool)
             else:
                 vin = f"SIM_{random.randint(1000, 9999)}"
         
         # Generate simulated telemetry data
         telemetry_data = self._generate_telemetry(vin)
         
-        # Store in database
-        db = get_database()
-        telemetry_doc = VehicleTelemetry(**telemetry_data)
-        await db.vehicle_telemetry.insert_one(telemetry_doc.dict(by_alias=True))
+        # Store in database (generated values are in range, so no model round trip)
+        await _store_telemetry({**telemetry_data, "created_at": telemetry_data["timestamp"]})
+        invalidate_telemetry(vin)
         
         return {
             "status": "success",
@@ -36,55 +202,115 @@ class TelemetryAgent(BaseAgent):
             "message": "Telemetry data ingested successfully"
         }
     
-    def _generate_telemetry(self, vin: str) -> Dict[str, Any]:
-        """Generate simulated vehicle telemetry data"""
-        # Simulate realistic vehicle data with occasional anomalies
-        base_temp = 85.0
-        base_pressure = 45.0
-        base_vibration = 2.5
-        base_voltage = 12.6
-        base_speed = random.uniform(0, 100)
+    async def _ingest_batch(self, vins: List[str]) -> Dict[str, Any]:
+        """Generate and store one telemetry sample per VIN in a single write"""
+        telemetry_batch = self._generate_telemetry_batch(vins)
         
-        # Introduce occasional anomalies (10% chance)
-        anomaly = random.random() < 0.1
+        db = get_database()
+        await db.vehicle_telemetry.insert_many(
+            [{**telemetry, "created_at": telemetry["timestamp"]} for telemetry in telemetry_batch],
+            ordered=False
+        )
+        for vin in set(vins):
+            invalidate_telemetry(vin)
         
-        engine_temp = base_temp + random.uniform(-5, 10)
-        if anomaly:
-            engine_temp = random.uniform(95, 130)  # Overheating
+        # Counts only: echoing every sample would bloat the response and the agent log
+        return {
+            "status": "success",
+            "ingested_count": len(telemetry_batch),
+            "anomaly_count": sum(1 for telemetry in telemetry_batch if telemetry["anomaly_detected"]),
+            "message": f"Telemetry data ingested for {len(telemetry_batch)} vehicles"
+        }
+    
+    def _generate_telemetry_batch(self, vins: List[str]) -> List[Dict[str, Any]]:
+        """Vectorised variant of _generate_telemetry for simulating many vehicles at once"""
+        n = len(vins)
+        rng = np.random.default_rng()
         
-        oil_pressure = base_pressure + random.uniform(-5, 5)
-        if anomaly:
-            oil_pressure = random.uniform(10, 25)  # Low pressure
+        readings = TELEMETRY_BASELINE + rng.uniform(TELEMETRY_NOISE_LOW, TELEMETRY_NOISE_HIGH, size=(n, 4))
+        anomalies = rng.random(n) < 0.1
+        readings[anomalies] = rng.uniform(
+            TELEMETRY_ANOMALY_LOW, TELEMETRY_ANOMALY_HIGH, size=(int(anomalies.sum()), 4)
+        )
+        speeds = rng.uniform(0, 100, size=n)
+        mileages = rng.uniform(1000, 100000, size=n)
         
-        vibration = base_vibration + random.uniform(-0.5, 0.5)
-        if anomaly:
-            vibration = random.uniform(5.0, 10.0)  # High vibration
+        penalties = np.maximum(0.0, (readings - HEALTH_PENALTY_THRESHOLDS) * HEALTH_PENALTY_SIGN)
+        health_scores = np.maximum(100.0 - penalties @ HEALTH_PENALTY_WEIGHTS, 0.0)
         
-        voltage = base_voltage + random.uniform(-0.5, 0.5)
-        if anomaly:
-            voltage = random.uniform(10.0, 11.5)  # Low voltage
+        overheat = readings[:, 0] > 105
+        low_oil = readings[:, 1] < 25
+        misfire = readings[:, 2] > 6.0
+        
+        readings = readings.round(2).tolist()
+        speeds = speeds.round(2).tolist()
+        health_scores = health_scores.round(2).tolist()
+        timestamp = datetime.utcnow()
         
-        # Calculate health score (0-100)
-        health_score = 100.0
-        if engine_temp > 100:
-            health_score -= (engine_temp - 100) * 2
-        if oil_pressure < 30:
-            health_score -= (30 - oil_pressure) * 1.5
-        if vibration > 4.0:
-            health_score -= (vibration - 4.0) * 5
-        if voltage < 12.0:
-            health_score -= (12.0 - voltage) * 3
+        batch = []
+        for i, vin in enumerate(vins):
+            error_codes = []
+            if overheat[i]:
+                error_codes.append("P0217")
+            if low_oil[i]:
+                error_codes.append("P0521")
+            if misfire[i]:
+                error_codes.append("P0300")
+            engine_temp, oil_pressure, vibration, voltage = readings[i]
+            batch.append({
+                "vin": vin,
+                "timestamp": timestamp,
+                "engine_temperature": engine_temp,
+                "oil_pressure": oil_pressure,
+                "vibration_level": vibration,
+                "battery_voltage": voltage,
+                "speed": speeds[i],
+                "mileage": float(mileages[i]),
+                "error_codes": error_codes,
+                "health_score": health_scores[i],
+                "anomaly_detected": bool(anomalies[i]),
+                "prediction_risk": 0.0
+            })
+        return batch
+    
+    def _generate_telemetry(self, vin: str) -> Dict[str, Any]:
+        """Generate simulated vehicle telemetry data"""
+        # Simulate realistic vehicle data with occasional anomalies
+        uniform = _uniform
+        base_speed = uniform(0, 100)
+        
+        # Introduce occasional anomalies (10% chance); only the readings for
+        # the branch taken are drawn
+        anomaly = _random() < 0.1
+        if anomaly:
+            engine_temp = uniform(95, 130)  # Overheating
+            oil_pressure = uniform(10, 25)  # Low pressure
+            vibration = uniform(5.0, 10.0)  # High vibration
+            voltage = uniform(10.0, 11.5)  # Low voltage
+        else:
+            engine_temp = 85.0 + uniform(-5, 10)
+            oil_pressure = 45.0 + uniform(-5, 5)
+            vibration = 2.5 + uniform(-0.5, 0.5)
+            voltage = 12.6 + uniform(-0.5, 0.5)
         
-        health_score = max(0, min(100, health_score))
+        # Calculate health score (0-100): a penalty per unit past each threshold
+        health_score = (
+            100.0
+            - max(0.0, engine_temp - 100) * 2
+            - max(0.0, 30 - oil_pressure) * 1.5
+            - max(0.0, vibration - 4.0) * 5
+            - max(0.0, 12.0 - voltage) * 3
+        )
+        health_score = 0.0 if health_score < 0 else health_score
         
-        # Error codes (OBD-II style)
-        error_codes = []
-        if engine_temp > 105:
-            error_codes.append("P0217")  # Engine overheat
-        if oil_pressure < 25:
-            error_codes.append("P0521")  # Oil pressure low
-        if vibration > 6.0:
-            error_codes.append("P0300")  # Random misfire
+        # Error codes (OBD-II style): engine overheat, oil pressure low, random misfire
+        error_codes = [
+            code for code, triggered in (
+                ("P0217", engine_temp > 105),
+                ("P0521", oil_pressure < 25),
+                ("P0300", vibration > 6.0),
+            ) if triggered
+        ]
         
         return {
             "vin": vin,
@@ -94,7 +320,7 @@ class TelemetryAgent(BaseAgent):
             "vibration_level": round(vibration, 2),
             "battery_voltage": round(voltage, 2),
             "speed": round(base_speed, 2),
-            "mileage": random.uniform(1000, 100000),
+            "mileage": uniform(1000, 100000),
             "error_codes": error_codes,
             "health_score": round(health_score, 2),
             "anomaly_detected": anomaly,
@@ -1,82 +1,170 @@
-from typing import Dict, Any, List
+import asyncio
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta
-from collections import Counter
+from pymongo import UpdateOne
 from app.agents.base_agent import BaseAgent
 from app.core.database import get_database
 from app.models.security import SecurityEvent
 from sklearn.ensemble import IsolationForest
 import numpy as np
-import uuid
+import time
+
+# The forest is refitted when it is this old or this many logs have been
+# written since the newest log it was fitted on
+MODEL_REFIT_INTERVAL_SECONDS = 3600
+MODEL_REFIT_NEW_LOGS = 500
+
+# Log analysis runs in the background on this cadence; requests are served the
+# latest completed result
+ANALYSIS_INTERVAL_SECONDS = 60
+# Most recent logs analysed per run; also the row count of the reused feature buffer
+ANALYSIS_LOG_LIMIT = 1000
+ANALYSIS_FEATURE_COUNT = 4
+
+
+def _payload_size(field: str) -> Dict[str, Any]:
+    """Stored payload size, computed server-side for logs written before sizes were stored"""
+    return {"$ifNull": [
+        f"${field}_size", {"$size": {"$objectToArray": {"$ifNull": [f"${field}", {}]}}}
+    ]}
+
+
+# Log analysis reads numeric feature fields and payload sizes, never the
+# payloads themselves; older logs get the same values derived server-side
+AGENT_LOG_ANALYSIS_PROJECTION = {
+    "agent_name": 1, "action": 1, "timestamp": 1, "status": 1,
+    "is_anomaly": {"$ifNull": ["$is_anomaly", False]},
+    "execution_time_ms": {"$ifNull": ["$execution_time_ms", 0]},
+    "is_error": {"$ifNull": ["$is_error", {"$eq": ["$status", "error"]}]},
+    "input_data_size": _payload_size("input_data"),
+    "output_data_size": _payload_size("output_data"),
+}
 
 class UEBASecurityAgent(BaseAgent):
     """Detects abnormal agent behavior using UEBA"""
     
+    __slots__ = (
+        "model", "is_fitted", "fitted_at", "fitted_through", "latest_analysis", "_analysis_task", "_model_lock",
+        "_feature_buffer",
+    )
+    
     def __init__(self):
         super().__init__("UEBASecurityAgent")
-        self.model = IsolationForest(contamination=0.05, random_state=42)
+        # Single-process fit: the analysis already runs in a worker thread, and
+        # n_jobs > 1 would copy X into every joblib worker
+        self.model = IsolationForest(
+            n_estimators=100, max_samples="auto", contamination=0.05, n_jobs=1, random_state=42
+        )
         self.is_fitted = False
+        self.fitted_at = 0.0
+        self.fitted_through = datetime.min
+        self.latest_analysis: Optional[Dict[str, Any]] = None
+        self._analysis_task: Optional[asyncio.Task] = None
+        self._model_lock = asyncio.Lock()
+        # float32 is what IsolationForest converts to internally, so no copy is made
+        self._feature_buffer = np.empty((ANALYSIS_LOG_LIMIT, ANALYSIS_FEATURE_COUNT), dtype=np.float32)
     
     async def _execute(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
         action = input_data.get("action", "analyze_logs")
         
         if action == "analyze_logs":
-            return await self._analyze_agent_logs()
+            if self.latest_analysis is not None and not input_data.get("refresh"):
+                return self.latest_analysis
+            return await self._run_analysis()
         elif action == "check_specific_agent":
             return await self._check_agent(input_data.get("agent_name"))
         else:
             return {"status": "error", "message": "Unknown action"}
     
+    def start_background_analysis(self) -> None:
+        """Start the periodic log analysis task (idempotent)"""
+        if self._analysis_task is None or self._analysis_task.done():
+            self._analysis_task = asyncio.create_task(self._analysis_loop())
+    
+    async def stop_background_analysis(self) -> None:
+        """Stop the periodic log analysis task"""
+        if self._analysis_task is not None:
+            self._analysis_task.cancel()
+            try:
+                await self._analysis_task
+            except asyncio.CancelledError:
+                pass
+            self._analysis_task = None
+    
+    async def _analysis_loop(self) -> None:
+        # Calls _run_analysis directly rather than execute(), so background runs
+        # do not write agent logs of their own into the window being analysed
+        while True:
+            try:
+                result = await self._run_analysis()
+                if result.get("status") != "success":
+                    print(f"Warning: background UEBA analysis failed: {result.get('message')}")
+            except Exception as e:
+                # Keep serving the previous result until a run succeeds
+                print(f"Warning: background UEBA analysis failed: {e}")
+            await asyncio.sleep(ANALYSIS_INTERVAL_SECONDS)
+    
+    async def _run_analysis(self) -> Dict[str, Any]:
+        """Analyze agent logs now and keep the result for later requests"""
+        result = await self._analyze_agent_logs()
+        if result.get("status") == "success":
+            self.latest_analysis = {**result, "analyzed_at": datetime.utcnow()}
+            return self.latest_analysis
+        return result
+    
     async def _analyze_agent_logs(self) -> Dict[str, Any]:
         """Analyze agent logs for anomalies"""
         db = get_database()
         
         # Get recent logs (last 24 hours)
         cutoff_time = datetime.utcnow() - timedelta(hours=24)
-        logs = await db.agent_logs.find({
-            "timestamp": {"$gte": cutoff_time}
-        }).to_list(1000)
+        logs = await db.agent_logs.find(
+            {"timestamp": {"$gte": cutoff_time}}, AGENT_LOG_ANALYSIS_PROJECTION
+        ).sort("timestamp", -1).limit(ANALYSIS_LOG_LIMIT).to_list(ANALYSIS_LOG_LIMIT)
         
         if not logs:
             return {"status": "success", "anomalies": [], "message": "No logs to analyze"}
         
-        # Extract features for analysis
-        features = []
-        for log in logs:
-            features.append([
-                log.get("execution_time_ms", 0),
-                1 if log.get("status") == "error" else 0,
-                len(log.get("input_data", {})),
-                len(log.get("output_data", {})),
-            ])
-        
-        # Train model if needed
-        if not self.is_fitted or len(features) > 100:
-            if len(features) >= 10:
-                X = np.array(features)
-                self.model.fit(X)
-                self.is_fitted = True
+        n = len(logs)
+        
+        # Forest fitting and scoring are CPU-bound, so they run off the event
+        # loop; the lock keeps a forced refresh and the background run from
+        # fitting the shared model (or refilling the shared buffer) at the same time
+        async with self._model_lock:
+            # Extract features for analysis into the reused buffer
+            X = self._feature_buffer[:n]
+            X[:] = [
+                (log["execution_time_ms"], log["is_error"], log["input_data_size"], log["output_data_size"])
+                for log in logs
+            ]
+            anomaly_scores, offset = await asyncio.to_thread(self._fit_and_score, X, logs)
         
         # Detect anomalies
         anomalies = []
-        if self.is_fitted and len(features) > 0:
-            X = np.array(features)
-            predictions = self.model.predict(X)
-            anomaly_scores = self.model.score_samples(X)
+        if anomaly_scores is not None:
+            outliers = anomaly_scores < offset
             
-            # Normalize scores to 0-1 range
-            min_score = anomaly_scores.min()
-            max_score = anomaly_scores.max()
-            normalized_scores = (anomaly_scores - min_score) / (max_score - min_score) if max_score != min_score else [0.5] * len(anomaly_scores)
+            # Normalize scores to 0-1 range, inverted so higher = more anomalous
+            score_range = np.ptp(anomaly_scores)
+            if score_range:
+                inverted_scores = ((anomaly_scores.max() - anomaly_scores) / score_range).tolist()
+            else:
+                inverted_scores = [0.5] * n
             
+            log_updates = []
+            critical_logs = []
             for i, log in enumerate(logs):
-                is_anomaly = predictions[i] == -1
-                score = float(1 - normalized_scores[i])  # Invert so higher = more anomalous
+                is_anomaly = bool(outliers[i])
+                score = inverted_scores[i]
+                
+                # Logs flagged by an earlier run were already handled then
+                already_flagged = log["is_anomaly"]
                 
                 # Update log with anomaly detection
-                await db.agent_logs.update_one(
+                log_updates.append(UpdateOne(
                     {"_id": log["_id"]},
                     {"$set": {"anomaly_score": score, "is_anomaly": is_anomaly}}
-                )
+                ))
                 
                 if is_anomaly or score > 0.7:
                     anomalies.append({
@@ -89,8 +177,29 @@ class UEBASecurityAgent(BaseAgent):
                     })
                     
                     # Create security event for critical anomalies
-                    if score > 0.8:
-                        await self._create_security_event(log, score)
+                    if score > 0.8 and not already_flagged:
+                        critical_logs.append((log, score))
+            
+            # Ship all score updates and new events in one round trip each.
+            # Events are keyed on their source log, so re-analysing the same
+            # 24-hour window never records a log's event twice
+            await db.agent_logs.bulk_write(log_updates, ordered=False)
+            if critical_logs:
+                # Only critical anomalies need their input payload, for the event details
+                payloads = {
+                    doc["_id"]: doc.get("input_data")
+                    async for doc in db.agent_logs.find(
+                        {"_id": {"$in": [log["_id"] for log, _ in critical_logs]}}, {"input_data": 1}
+                    )
+                }
+                events = [
+                    self._build_security_event({**log, "input_data": payloads.get(log["_id"])}, score)
+                    for log, score in critical_logs
+                ]
+                await db.security_events.bulk_write([
+                    UpdateOne({"event_id": event["event_id"]}, {"$setOnInsert": event}, upsert=True)
+                    for event in events
+                ], ordered=False)
         
         return {
             "status": "success",
@@ -99,45 +208,82 @@ class UEBASecurityAgent(BaseAgent):
             "anomaly_count": len(anomalies)
         }
     
+    def _fit_and_score(self, X: np.ndarray, logs: List[Dict[str, Any]]) -> Tuple[Optional[np.ndarray], float]:
+        """Refit the forest if needed, then score X; scores are None while no model is fitted"""
+        if len(logs) >= 10 and self._needs_refit(logs):
+            self.model.fit(X)
+            self.is_fitted = True
+            self.fitted_at = time.monotonic()
+            self.fitted_through = max(log["timestamp"] for log in logs)
+        
+        if not self.is_fitted:
+            return None, 0.0
+        # One pass over the forest; predict() is score_samples() < offset_
+        return self.model.score_samples(X), self.model.offset_
+    
+    def _needs_refit(self, logs: List[Dict[str, Any]]) -> bool:
+        """Whether the model is missing, stale, or behind on new logs"""
+        if not self.is_fitted:
+            return True
+        if time.monotonic() - self.fitted_at > MODEL_REFIT_INTERVAL_SECONDS:
+            return True
+        new_logs = sum(1 for log in logs if log["timestamp"] > self.fitted_through)
+        return new_logs >= MODEL_REFIT_NEW_LOGS
+    
     async def _check_agent(self, agent_name: str) -> Dict[str, Any]:
         """Check specific agent for anomalies"""
         db = get_database()
         
-        # Get recent logs for this agent
+        # Summarise the agent's 100 most recent logs per action on the server
         cutoff_time = datetime.utcnow() - timedelta(hours=24)
-        logs = await db.agent_logs.find({
-            "agent_name": agent_name,
-            "timestamp": {"$gte": cutoff_time}
-        }).sort("timestamp", -1).limit(100).to_list(100)
+        groups = await db.agent_logs.aggregate([
+            {"$match": {"agent_name": agent_name, "timestamp": {"$gte": cutoff_time}}},
+            {"$sort": {"timestamp": -1}},
+            {"$limit": 100},
+            {"$group": {
+                "_id": "$action",
+                "count": {"$sum": 1},
+                "error_count": {"$sum": {"$cond": [{"$eq": ["$status", "error"]}, 1, 0]}},
+                "execution_time_ms": {"$sum": "$execution_time_ms"},
+                "anomaly_count": {"$sum": {"$cond": ["$is_anomaly", 1, 0]}},
+                "anomaly_score": {"$sum": "$anomaly_score"},
+            }},
+        ]).to_list(None)
         
-        if not logs:
+        if not groups:
             return {"status": "success", "message": "No recent activity for this agent"}
         
-        # Calculate statistics
-        error_count = sum(1 for log in logs if log.get("status") == "error")
-        avg_execution_time = sum(log.get("execution_time_ms", 0) for log in logs) / len(logs)
-        anomaly_count = sum(1 for log in logs if log.get("is_anomaly", False))
-        avg_anomaly_score = sum(log.get("anomaly_score", 0) for log in logs) / len(logs)
+        # Calculate statistics and action frequencies in one pass over the groups
+        total_actions = error_count = anomaly_count = 0
+        total_execution_time = total_anomaly_score = 0.0
+        action_counts = {}
+        for g in groups:
+            total_actions += g["count"]
+            error_count += g["error_count"]
+            anomaly_count += g["anomaly_count"]
+            total_execution_time += g["execution_time_ms"]
+            total_anomaly_score += g["anomaly_score"]
+            action_counts[g["_id"]] = g["count"]
+        avg_execution_time = total_execution_time / total_actions
+        avg_anomaly_score = total_anomaly_score / total_actions
         
         # Check for patterns
-        actions = [log.get("action") for log in logs]
-        action_counts = Counter(actions)
-        most_common_action = action_counts.most_common(1)[0] if action_counts else None
+        most_common_action = max(action_counts, key=action_counts.get)
         
         return {
             "status": "success",
             "agent_name": agent_name,
             "statistics": {
-                "total_actions": len(logs),
+                "total_actions": total_actions,
                 "error_count": error_count,
-                "error_rate": round(error_count / len(logs) * 100, 2),
+                "error_rate": round(error_count / total_actions * 100, 2),
                 "average_execution_time_ms": round(avg_execution_time, 2),
                 "anomaly_count": anomaly_count,
                 "average_anomaly_score": round(avg_anomaly_score, 3),
-                "most_common_action": most_common_action[0] if most_common_action else None,
-                "action_frequency": dict(action_counts)
+                "most_common_action": most_common_action,
+                "action_frequency": action_counts
             },
-            "risk_level": self._assess_risk(error_count, avg_anomaly_score, len(logs))
+            "risk_level": self._assess_risk(error_count, avg_anomaly_score, total_actions)
         }
     
     def _assess_risk(self, error_count: int, avg_anomaly_score: float, total_actions: int) -> str:
@@ -151,11 +297,10 @@ class UEBASecurityAgent(BaseAgent):
         else:
             return "low"
     
-    async def _create_security_event(self, log: Dict[str, Any], anomaly_score: float) -> None:
-        """Create security event for critical anomalies"""
-        db = get_database()
-        
-        event_id = f"SEC_{uuid.uuid4().hex[:8].upper()}"
+    def _build_security_event(self, log: Dict[str, Any], anomaly_score: float) -> Dict[str, Any]:
+        """Build security event document for a critical anomaly"""
+        # Derived from the source log so each log yields at most one event
+        event_id = f"SEC_{log['_id']}"
         
         # Determine severity
         if anomaly_score > 0.9:
@@ -181,5 +326,5 @@ class UEBASecurityAgent(BaseAgent):
             resolved=False
         )
         
-        await db.security_events.insert_one(event.dict(by_alias=True))
+        return event.dict(by_alias=True)
 
@@ -1,6 +1,8 @@
+import asyncio
 from fastapi import APIRouter, HTTPException, Depends, status
 from fastapi.security import HTTPBearer
 from pydantic import BaseModel
+from pymongo.errors import DuplicateKeyError
 from datetime import timedelta
 from datetime import datetime
 from app.core.security import verify_password, get_password_hash, create_access_token
@@ -10,6 +12,9 @@ from app.models.security import User
 
 router = APIRouter()
 
+# Login only needs the credentials check and the token/response fields
+LOGIN_USER_PROJECTION = {"_id": 0, "username": 1, "email": 1, "role": 1, "hashed_password": 1, "is_active": 1}
+
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -25,17 +30,18 @@ async def register(user_data: RegisterRequest):
     """Register new user"""
     db = get_database()
     
-    # Check if user exists
-    existing_user = await db.users.find_one({"username": user_data.username})
+    # Check if username or email is taken (one round trip, both fields indexed)
+    existing_user = await db.users.find_one(
+        {"$or": [{"username": user_data.username}, {"email": user_data.email}]},
+        {"_id": 0, "username": 1}
+    )
     if existing_user:
-        raise HTTPException(status_code=400, detail="Username already registered")
-    
-    existing_email = await db.users.find_one({"email": user_data.email})
-    if existing_email:
+        if existing_user.get("username") == user_data.username:
+            raise HTTPException(status_code=400, detail="Username already registered")
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    # Create user
-    hashed_password = get_password_hash(user_data.password)
+    # Create user (bcrypt runs off the event loop; it releases the GIL)
+    hashed_password = await asyncio.to_thread(get_password_hash, user_data.password)
     user = User(
         username=user_data.username,
         email=user_data.email,
@@ -43,7 +49,11 @@ async def register(user_data: RegisterRequest):
         role=user_data.role
     )
     
-    await db.users.insert_one(user.dict(by_alias=True))
+    try:
+        await db.users.insert_one(user.dict(by_alias=True))
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration; the unique indexes caught it
+        raise HTTPException(status_code=400, detail="Username or email already registered")
     
     return {"status": "success", "message": "User registered successfully"}
 
@@ -52,11 +62,11 @@ async def login(login_data: LoginRequest):
     """Login user"""
     db = get_database()
     
-    user = await db.users.find_one({"username": login_data.username})
+    user = await db.users.find_one({"username": login_data.username}, LOGIN_USER_PROJECTION)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
-    if not verify_password(login_data.password, user["hashed_password"]):
+    if not await asyncio.to_thread(verify_password, login_data.password, user["hashed_password"]):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     if not user.get("is_active", True):
@@ -1,22 +1,33 @@
-from fastapi import Depends, HTTPException, status, Request
+from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
+import time
+from cachetools import TTLCache
 from app.core.security import decode_access_token
 from app.core.database import get_database
 from app.models.security import User
 
 security = HTTPBearer(auto_error=False)
 
+# Authenticated users keyed by raw token, so repeat requests skip the JWT
+# decode and the users lookup. Entries also carry the token expiry, which is
+# re-checked on every hit. Cached users never hold the password hash.
+USER_CACHE_MAXSIZE = 10_000
+USER_CACHE_TTL_SECONDS = 60
+CURRENT_USER_PROJECTION = {"hashed_password": 0}
+
+_user_cache: "TTLCache[str, Tuple[Dict[str, Any], float]]" = TTLCache(
+    maxsize=USER_CACHE_MAXSIZE, ttl=USER_CACHE_TTL_SECONDS
+)
+
 async def get_current_user(
-    request: Request,
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)
 ) -> dict:
-    """Get current authenticated user - Allows OPTIONS requests to bypass auth"""
-    # Allow OPTIONS requests (CORS preflight) to bypass authentication
-    if request.method == "OPTIONS":
-        # Return a dummy user for OPTIONS requests
-        return {"username": "anonymous", "role": "anonymous", "customer_id": None}
-    
+    """Get current authenticated user (CORS preflights are answered by CORSMiddleware before routing).
+
+    Users are cached per token for USER_CACHE_TTL_SECONDS, so role and account
+    changes (including deactivation) can take up to that long to apply.
+    """
     if credentials is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -25,6 +36,10 @@ async def get_current_user(
         )
     
     token = credentials.credentials
+    cached = _user_cache.get(token)
+    if cached is not None and time.time() < cached[1]:
+        return dict(cached[0])
+    
     payload = decode_access_token(token)
     
     if payload is None:
@@ -42,7 +57,7 @@ async def get_current_user(
         )
     
     db = get_database()
-    user = await db.users.find_one({"username": username})
+    user = await db.users.find_one({"username": username}, CURRENT_USER_PROJECTION)
     
     if user is None:
         raise HTTPException(
@@ -50,13 +65,16 @@ async def get_current_user(
             detail="User not found",
         )
     
-    return user
+    _user_cache[token] = (user, payload.get("exp", 0))
+    return dict(user)
 
 def require_role(required_role: str):
     """Dependency factory to require specific role"""
+    # Admins pass every role check
+    allowed_roles = frozenset((required_role, "admin"))
+    
     async def role_checker(current_user: dict = Depends(get_current_user)):
-        user_role = current_user.get("role", "customer")
-        if user_role != required_role and user_role != "admin":
+        if current_user.get("role", "customer") not in allowed_roles:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail=f"Requires {required_role} role"
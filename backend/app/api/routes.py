@@ -1,10 +1,23 @@
+import asyncio
+import re
+import orjson
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, status, Query
+from fastapi.responses import ORJSONResponse
 from typing import List, Optional
 from datetime import datetime, timedelta
 from bson import ObjectId
 from app.api.dependencies import get_current_user, require_role
 from app.agents.master_agent import MasterAgent
+from app.agents.smart_scheduling_agent import claim_technician, extract_issue_category
 from app.core.database import get_database
+from app.core.mongo_cache import (
+    get_active_service_centers,
+    get_prediction,
+    invalidate_customer,
+    invalidate_service_centers,
+    invalidate_telemetry,
+    invalidate_vehicle,
+)
 from app.models.vehicle import Vehicle, VehicleTelemetry
 from app.models.customer import Customer, ServiceAppointment, Feedback
 from app.models.service_center import ServiceCenter, Technician
@@ -14,24 +27,127 @@ from app.models.security import User, SecurityEvent
 router = APIRouter()
 master_agent = MasterAgent()
 
-# Helper function to convert ObjectId and datetime to JSON-serializable formats
-def convert_objectid(obj):
-    """Recursively convert ObjectId to string and datetime to ISO format for JSON serialization"""
+def _encode_bson(obj):
+    """orjson fallback for the BSON types orjson cannot serialize itself"""
     if isinstance(obj, ObjectId):
         return str(obj)
-    elif isinstance(obj, dict):
-        return {k: convert_objectid(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_objectid(item) for item in obj]
-    elif isinstance(obj, datetime):
-        return obj.isoformat()
-    return obj
+    raise TypeError
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """Serializes raw MongoDB documents in one orjson pass (ObjectId as string, datetime as ISO 8601).
+    Returned directly so FastAPI skips jsonable_encoder, which rejects ObjectId."""
+    def render(self, content) -> bytes:
+        return orjson.dumps(
+            content, default=_encode_bson, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+
+
+def _lookup_one(collection: str, local_field: str, foreign_field: str, fields: List[str], as_field: str) -> dict:
+    """$lookup stage joining at most one document with only the given fields"""
+    return {"$lookup": {
+        "from": collection,
+        "let": {"key": f"${local_field}"},
+        "pipeline": [
+            {"$match": {"$expr": {"$eq": [f"${foreign_field}", "$$key"]}}},
+            {"$limit": 1},
+            {"$project": {"_id": 0, **{field: 1 for field in fields}}},
+        ],
+        "as": as_field,
+    }}
+
+
+# Appointment listings join vehicle, technician and customer details server-side
+APPOINTMENT_VEHICLE_LOOKUP = _lookup_one("vehicles", "vin", "vin", ["vehicle_name", "model", "plate_number"], "_vehicle")
+APPOINTMENT_TECHNICIAN_LOOKUP = _lookup_one(
+    "technicians", "technician_id", "technician_id", ["name", "specialization"], "_technician"
+)
+APPOINTMENT_CUSTOMER_LOOKUP = _lookup_one("customers", "customer_id", "customer_id", ["name"], "_customer")
+
+# Reads that only need a few fields fetch just those
+TELEMETRY_HEALTH_PROJECTION = {"_id": 0, "health_score": 1, "prediction_risk": 1}
+VEHICLE_OWNER_PROJECTION = {"_id": 0, "vin": 1, "customer_id": 1}
+VEHICLE_SUMMARY_PROJECTION = {"_id": 0, "vin": 1, "vehicle_name": 1, "model": 1, "plate_number": 1}
+TECHNICIAN_WORKLOAD_PROJECTION = {
+    "_id": 0, "technician_id": 1, "name": 1, "current_assignments": 1, "max_capacity": 1, "status": 1,
+}
+NAME_PROJECTION = {"_id": 0, "name": 1}
+
+
+def _apply_appointment_details(apt: dict, include_specialization: bool = False) -> dict:
+    """Flatten joined vehicle/technician/customer details into an appointment response dict"""
+    vehicles = apt.pop("_vehicle", None)
+    technicians = apt.pop("_technician", None)
+    customers = apt.pop("_customer", None)
+    apt_dict = apt
+    
+    if vehicles and apt.get("vin"):
+        vehicle = vehicles[0]
+        apt_dict["vehicle_name"] = vehicle.get("vehicle_name") or vehicle.get("model")
+        apt_dict["plate_number"] = vehicle.get("plate_number")
+    
+    if customers and apt.get("customer_id"):
+        apt_dict["customer_name"] = customers[0].get("name")
+    
+    technician_id = apt.get("technician_id")
+    if technician_id:
+        if technicians:
+            apt_dict["technician_name"] = technicians[0].get("name", technician_id)
+            if include_specialization:
+                apt_dict["technician_specialization"] = technicians[0].get("specialization", [])
+        else:
+            apt_dict["technician_name"] = technician_id
+    else:
+        apt_dict["technician_name"] = None
+    
+    return apt_dict
+
+
+async def _predict(vin: str) -> dict:
+    """Failure prediction for a vehicle, shared across requests until it expires or new telemetry arrives"""
+    return await get_prediction(vin, lambda: master_agent.failure_prediction_agent.execute({"vin": vin}))
+
+
+async def _pre_diagnose(db, vin: str) -> dict:
+    """Predicted issue, health and risk for a vehicle, falling back to its latest telemetry"""
+    diagnosis = {}
+    try:
+        prediction_result = await _predict(vin)
+        if prediction_result.get("status") == "success":
+            diagnosis["predicted_issue"] = prediction_result.get("recommendation", "General maintenance required")
+            diagnosis["health_score"] = prediction_result.get("health_score", 100.0)
+            diagnosis["risk_score"] = prediction_result.get("risk_score", 0.0)
+        else:
+            # Fallback to telemetry
+            latest = await db.vehicle_telemetry.find_one(
+                {"vin": vin}, TELEMETRY_HEALTH_PROJECTION, sort=[("timestamp", -1)]
+            )
+            if latest is not None:
+                health = latest.get("health_score", 100.0)
+                diagnosis["health_score"] = health
+                diagnosis["risk_score"] = latest.get("prediction_risk", (100 - health) / 100.0)
+                if health < 50:
+                    diagnosis["predicted_issue"] = "Critical health issues detected - immediate attention required"
+                elif health < 70:
+                    diagnosis["predicted_issue"] = "Elevated risk indicators - preventive maintenance recommended"
+                else:
+                    diagnosis["predicted_issue"] = "General maintenance service"
+    except Exception:
+        diagnosis = {"predicted_issue": "General maintenance service", "health_score": 100.0, "risk_score": 0.0}
+    return diagnosis
+
+
+async def _pre_diagnose_vins(db, vins: List[str]) -> dict:
+    """Pre-diagnose each distinct VIN concurrently; returns {vin: diagnosis}"""
+    unique_vins = list(dict.fromkeys(vins))
+    diagnoses = await asyncio.gather(*(_pre_diagnose(db, vin) for vin in unique_vins))
+    return dict(zip(unique_vins, diagnoses))
 
 # Health check
 @router.get("/health")
 async def health_check():
     """Health check - also reports MongoDB connectivity when available."""
-    status = {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    status = {"status": "healthy", "timestamp": datetime.utcnow()}
     try:
         # Try to check DB connectivity if available
         db = get_database()
@@ -83,7 +199,7 @@ async def get_telemetry(
     user_role = current_user.get("role")
     if user_role == "customer":
         # Verify vehicle belongs to customer
-        vehicle = await db.vehicles.find_one({"vin": vin})
+        vehicle = await db.vehicles.find_one({"vin": vin}, VEHICLE_OWNER_PROJECTION)
         if not vehicle:
             raise HTTPException(status_code=404, detail="Vehicle not found")
         
@@ -100,7 +216,7 @@ async def get_telemetry(
     telemetry = await db.vehicle_telemetry.find(
         {"vin": vin}
     ).sort("timestamp", -1).limit(limit).to_list(limit)
-    return {"vin": vin, "telemetry": telemetry}
+    return MongoJSONResponse({"vin": vin, "telemetry": telemetry})
 
 # Failure prediction endpoints
 @router.post("/predictions/predict")
@@ -152,16 +268,15 @@ async def schedule_appointment(
         try:
             db = get_database()
             # Try to get prediction from failure prediction agent
-            prediction_result = await master_agent.failure_prediction_agent.execute({"vin": vin})
+            prediction_result = await _predict(vin)
             if prediction_result.get("status") == "success":
                 predicted_issue = prediction_result.get("recommendation", "")
             else:
                 # Fallback to telemetry
-                recent_telemetry = await db.vehicle_telemetry.find(
-                    {"vin": vin}
-                ).sort("timestamp", -1).limit(1).to_list(1)
-                if recent_telemetry:
-                    latest = recent_telemetry[0]
+                latest = await db.vehicle_telemetry.find_one(
+                    {"vin": vin}, TELEMETRY_HEALTH_PROJECTION, sort=[("timestamp", -1)]
+                )
+                if latest is not None:
                     health = latest.get("health_score", 100.0)
                     if health < 50:
                         predicted_issue = "Critical health issues detected - immediate attention required"
@@ -257,12 +372,9 @@ async def get_appointments(
     # Only return active appointments (not cancelled) - rescheduled appointments are cancelled
     appointments = await db.service_appointments.find(
         {"customer_id": customer_id, "status": {"$ne": "cancelled"}}
-    ).sort("scheduled_date", -1).to_list(100)
+    ).sort("scheduled_date", -1).limit(100).batch_size(100).to_list(100)
     
-    # Convert ObjectId to string for JSON serialization
-    appointments = [convert_objectid(apt) for apt in appointments]
-    
-    return {"customer_id": customer_id, "appointments": appointments}
+    return MongoJSONResponse({"customer_id": customer_id, "appointments": appointments})
 
 # Service Center endpoints
 @router.get("/service-centers")
@@ -270,10 +382,8 @@ async def get_service_centers(
     current_user: dict = Depends(get_current_user)
 ):
     """Get all service centers - for service center selection"""
-    db = get_database()
-    centers = await db.service_centers.find({"status": "active"}).to_list(100)
-    centers = [convert_objectid(c) for c in centers]
-    return {"status": "success", "service_centers": centers}
+    centers = await get_active_service_centers()
+    return MongoJSONResponse({"status": "success", "service_centers": centers})
 
 @router.get("/service-centers/{center_id}/appointments")
 async def get_service_center_appointments(
@@ -295,63 +405,26 @@ async def get_service_center_appointments(
     today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     tomorrow = today + timedelta(days=1)
     
-    # Get ALL appointments (not just future) - for bookings page
-    appointments = await db.service_appointments.find({
-        "service_center_id": center_id,
-        "status": {"$ne": "cancelled"}
-    }).sort("scheduled_date", -1).to_list(100)
-    
-    # Get vehicle and prediction data for each appointment
+    # Get ALL appointments (not just future) - for bookings page, with vehicle
+    # and technician details joined in the same query
+    appointments = await db.service_appointments.aggregate([
+        {"$match": {"service_center_id": center_id, "status": {"$ne": "cancelled"}}},
+        {"$sort": {"scheduled_date": -1}},
+        {"$limit": 100},
+        APPOINTMENT_VEHICLE_LOOKUP,
+        APPOINTMENT_TECHNICIAN_LOOKUP,
+    ]).to_list(100)
+    
+    # Get prediction data for each appointment; vehicles are pre-diagnosed
+    # concurrently, once per distinct VIN
+    diagnoses = await _pre_diagnose_vins(db, [apt.get("vin") for apt in appointments])
     appointments_with_details = []
     for apt in appointments:
-        apt_dict = convert_objectid(apt)
-        vin = apt.get("vin")
-        
-        # Get vehicle info
-        vehicle = await db.vehicles.find_one({"vin": vin})
-        if vehicle:
-            apt_dict["vehicle_name"] = vehicle.get("vehicle_name") or vehicle.get("model")
-            apt_dict["plate_number"] = vehicle.get("plate_number")
-        
-        # Get technician name if technician_id is assigned
-        technician_id = apt.get("technician_id")
-        if technician_id:
-            technician = await db.technicians.find_one({"technician_id": technician_id})
-            if technician:
-                apt_dict["technician_name"] = technician.get("name", technician_id)
-            else:
-                apt_dict["technician_name"] = technician_id
-        else:
-            apt_dict["technician_name"] = None
-        
-        # Get prediction/telemetry for pre-diagnosis
-        try:
-            prediction_result = await master_agent.failure_prediction_agent.execute({"vin": vin})
-            if prediction_result.get("status") == "success":
-                apt_dict["predicted_issue"] = prediction_result.get("recommendation", "General maintenance required")
-                apt_dict["health_score"] = prediction_result.get("health_score", 100.0)
-            else:
-                # Fallback to telemetry
-                recent_telemetry = await db.vehicle_telemetry.find(
-                    {"vin": vin}
-                ).sort("timestamp", -1).limit(1).to_list(1)
-                if recent_telemetry:
-                    latest = recent_telemetry[0]
-                    health = latest.get("health_score", 100.0)
-                    apt_dict["health_score"] = health
-                    if health < 50:
-                        apt_dict["predicted_issue"] = "Critical health issues detected - immediate attention required"
-                    elif health < 70:
-                        apt_dict["predicted_issue"] = "Elevated risk indicators - preventive maintenance recommended"
-                    else:
-                        apt_dict["predicted_issue"] = "General maintenance service"
-        except Exception as e:
-            apt_dict["predicted_issue"] = "General maintenance service"
-            apt_dict["health_score"] = 100.0
-        
+        apt_dict = _apply_appointment_details(apt)
+        apt_dict.update(diagnoses[apt.get("vin")])
         appointments_with_details.append(apt_dict)
     
-    return {"status": "success", "appointments": appointments_with_details}
+    return MongoJSONResponse({"status": "success", "appointments": appointments_with_details})
 
 @router.get("/service-centers/{center_id}/pre-diagnosed-cases")
 async def get_pre_diagnosed_cases(
@@ -370,64 +443,23 @@ async def get_pre_diagnosed_cases(
     
     db = get_database()
     now = datetime.utcnow()
-    # Get upcoming appointments (scheduled, not yet started)
-    upcoming_appointments = await db.service_appointments.find({
-        "service_center_id": center_id,
-        "status": "scheduled",
-        "scheduled_date": {"$gte": now}
-    }).sort("scheduled_date", 1).to_list(50)
-    
-    # Get vehicle and prediction data for each appointment
+    # Get upcoming appointments (scheduled, not yet started) with vehicle and
+    # technician details joined in the same query
+    upcoming_appointments = await db.service_appointments.aggregate([
+        {"$match": {"service_center_id": center_id, "status": "scheduled", "scheduled_date": {"$gte": now}}},
+        {"$sort": {"scheduled_date": 1}},
+        {"$limit": 50},
+        APPOINTMENT_VEHICLE_LOOKUP,
+        APPOINTMENT_TECHNICIAN_LOOKUP,
+    ]).to_list(50)
+    
+    # Get prediction data for each appointment; vehicles are pre-diagnosed
+    # concurrently, once per distinct VIN
+    diagnoses = await _pre_diagnose_vins(db, [apt.get("vin") for apt in upcoming_appointments])
     pre_diagnosed_cases = []
     for apt in upcoming_appointments:
-        apt_dict = convert_objectid(apt)
-        vin = apt.get("vin")
-        
-        # Get vehicle info
-        vehicle = await db.vehicles.find_one({"vin": vin})
-        if vehicle:
-            apt_dict["vehicle_name"] = vehicle.get("vehicle_name") or vehicle.get("model")
-            apt_dict["plate_number"] = vehicle.get("plate_number")
-        
-        # Get technician name if assigned
-        technician_id = apt.get("technician_id")
-        if technician_id:
-            technician = await db.technicians.find_one({"technician_id": technician_id})
-            if technician:
-                apt_dict["technician_name"] = technician.get("name", technician_id)
-                apt_dict["technician_specialization"] = technician.get("specialization", [])
-            else:
-                apt_dict["technician_name"] = technician_id
-        else:
-            apt_dict["technician_name"] = None
-        
-        # Get prediction/telemetry for pre-diagnosis
-        try:
-            prediction_result = await master_agent.failure_prediction_agent.execute({"vin": vin})
-            if prediction_result.get("status") == "success":
-                apt_dict["predicted_issue"] = prediction_result.get("recommendation", "General maintenance required")
-                apt_dict["health_score"] = prediction_result.get("health_score", 100.0)
-                apt_dict["risk_score"] = prediction_result.get("risk_score", 0.0)
-            else:
-                # Fallback to telemetry
-                recent_telemetry = await db.vehicle_telemetry.find(
-                    {"vin": vin}
-                ).sort("timestamp", -1).limit(1).to_list(1)
-                if recent_telemetry:
-                    latest = recent_telemetry[0]
-                    health = latest.get("health_score", 100.0)
-                    apt_dict["health_score"] = health
-                    apt_dict["risk_score"] = latest.get("prediction_risk", (100 - health) / 100.0)
-                    if health < 50:
-                        apt_dict["predicted_issue"] = "Critical health issues detected - immediate attention required"
-                    elif health < 70:
-                        apt_dict["predicted_issue"] = "Elevated risk indicators - preventive maintenance recommended"
-                    else:
-                        apt_dict["predicted_issue"] = "General maintenance service"
-        except Exception as e:
-            apt_dict["predicted_issue"] = "General maintenance service"
-            apt_dict["health_score"] = 100.0
-            apt_dict["risk_score"] = 0.0
+        apt_dict = _apply_appointment_details(apt, include_specialization=True)
+        apt_dict.update(diagnoses[apt.get("vin")])
         
         # Determine recommended tools/parts based on predicted issue
         apt_dict["recommended_tools"] = _get_recommended_tools(apt_dict.get("predicted_issue", ""))
@@ -435,61 +467,55 @@ async def get_pre_diagnosed_cases(
         
         pre_diagnosed_cases.append(apt_dict)
     
-    return {"status": "success", "pre_diagnosed_cases": pre_diagnosed_cases}
+    return MongoJSONResponse({"status": "success", "pre_diagnosed_cases": pre_diagnosed_cases})
+
+def _compile_recommendation_rules(rules) -> tuple:
+    """Precompile (keywords, items) rules into (substring alternation, items) pairs"""
+    return tuple(
+        (re.compile("|".join(re.escape(keyword) for keyword in keywords)), items)
+        for keywords, items in rules
+    )
+
+
+# (issue keywords, recommended items) per issue type, compiled once at import
+_TOOL_RULES = _compile_recommendation_rules((
+    (("engine", "temperature", "overheating", "cooling"), ("Thermometer", "Cooling system pressure tester", "OBD scanner")),
+    (("electrical", "battery", "voltage"), ("Multimeter", "Battery tester", "Electrical diagnostic tools")),
+    (("brake", "braking"), ("Brake fluid tester", "Brake pad gauge", "Lift/jack")),
+    (("suspension", "alignment"), ("Alignment machine", "Suspension tester", "Lift/jack")),
+    (("transmission", "gearbox"), ("Transmission fluid tester", "OBD scanner", "Lift/jack")),
+    (("ac", "air conditioning", "cooling"), ("AC pressure gauge", "Refrigerant leak detector", "Thermometer")),
+))
+_PART_RULES = _compile_recommendation_rules((
+    (("engine", "temperature", "overheating"), ("Coolant", "Thermostat", "Radiator cap")),
+    (("electrical", "battery"), ("Battery", "Alternator", "Fuses")),
+    (("brake", "braking"), ("Brake pads", "Brake fluid", "Brake rotors")),
+    (("suspension",), ("Shock absorbers", "Struts", "Suspension bushings")),
+    (("transmission",), ("Transmission fluid", "Transmission filter")),
+    (("ac", "air conditioning"), ("Refrigerant", "AC filter", "AC compressor")),
+    (("oil", "lubrication"), ("Engine oil", "Oil filter", "Oil pan gasket")),
+))
+DEFAULT_TOOLS = ("Standard diagnostic tools", "OBD scanner")
+DEFAULT_PARTS = ("Standard maintenance parts",)
+
+
+def _recommend(predicted_issue: str, rules: tuple, default: tuple) -> list:
+    """Items of every rule matching the issue text, up to 5, or the defaults"""
+    items = []
+    if predicted_issue:
+        issue_lower = predicted_issue.lower()
+        for pattern, rule_items in rules:
+            if pattern.search(issue_lower):
+                items.extend(rule_items)
+    return items[:5] if items else list(default)
 
 def _get_recommended_tools(predicted_issue: str) -> list:
     """Get recommended tools based on predicted issue"""
-    if not predicted_issue:
-        return ["Standard diagnostic tools", "OBD scanner"]
-    
-    issue_lower = predicted_issue.lower()
-    tools = []
-    
-    if any(keyword in issue_lower for keyword in ["engine", "temperature", "overheating", "cooling"]):
-        tools.extend(["Thermometer", "Cooling system pressure tester", "OBD scanner"])
-    if any(keyword in issue_lower for keyword in ["electrical", "battery", "voltage"]):
-        tools.extend(["Multimeter", "Battery tester", "Electrical diagnostic tools"])
-    if any(keyword in issue_lower for keyword in ["brake", "braking"]):
-        tools.extend(["Brake fluid tester", "Brake pad gauge", "Lift/jack"])
-    if any(keyword in issue_lower for keyword in ["suspension", "alignment"]):
-        tools.extend(["Alignment machine", "Suspension tester", "Lift/jack"])
-    if any(keyword in issue_lower for keyword in ["transmission", "gearbox"]):
-        tools.extend(["Transmission fluid tester", "OBD scanner", "Lift/jack"])
-    if any(keyword in issue_lower for keyword in ["ac", "air conditioning", "cooling"]):
-        tools.extend(["AC pressure gauge", "Refrigerant leak detector", "Thermometer"])
-    
-    if not tools:
-        tools = ["Standard diagnostic tools", "OBD scanner"]
-    
-    return tools[:5]  # Limit to 5 tools
+    return _recommend(predicted_issue, _TOOL_RULES, DEFAULT_TOOLS)
 
 def _get_recommended_parts(predicted_issue: str) -> list:
     """Get recommended parts based on predicted issue"""
-    if not predicted_issue:
-        return ["Standard maintenance parts"]
-    
-    issue_lower = predicted_issue.lower()
-    parts = []
-    
-    if any(keyword in issue_lower for keyword in ["engine", "temperature", "overheating"]):
-        parts.extend(["Coolant", "Thermostat", "Radiator cap"])
-    if any(keyword in issue_lower for keyword in ["electrical", "battery"]):
-        parts.extend(["Battery", "Alternator", "Fuses"])
-    if any(keyword in issue_lower for keyword in ["brake", "braking"]):
-        parts.extend(["Brake pads", "Brake fluid", "Brake rotors"])
-    if any(keyword in issue_lower for keyword in ["suspension"]):
-        parts.extend(["Shock absorbers", "Struts", "Suspension bushings"])
-    if any(keyword in issue_lower for keyword in ["transmission"]):
-        parts.extend(["Transmission fluid", "Transmission filter"])
-    if any(keyword in issue_lower for keyword in ["ac", "air conditioning"]):
-        parts.extend(["Refrigerant", "AC filter", "AC compressor"])
-    if any(keyword in issue_lower for keyword in ["oil", "lubrication"]):
-        parts.extend(["Engine oil", "Oil filter", "Oil pan gasket"])
-    
-    if not parts:
-        parts = ["Standard maintenance parts"]
-    
-    return parts[:5]  # Limit to 5 parts
+    return _recommend(predicted_issue, _PART_RULES, DEFAULT_PARTS)
 
 @router.get("/service-centers/{center_id}/ongoing-bookings")
 async def get_ongoing_bookings(
@@ -508,45 +534,20 @@ async def get_ongoing_bookings(
     
     db = get_database()
     
-    # Get in_progress and completed appointments
-    appointments = await db.service_appointments.find({
-        "service_center_id": center_id,
-        "status": {"$in": ["in_progress", "completed"]}
-    }).sort("scheduled_date", -1).to_list(100)
+    # Get in_progress and completed appointments with vehicle, customer and
+    # technician details joined in the same query
+    appointments = await db.service_appointments.aggregate([
+        {"$match": {"service_center_id": center_id, "status": {"$in": ["in_progress", "completed"]}}},
+        {"$sort": {"scheduled_date": -1}},
+        {"$limit": 100},
+        APPOINTMENT_VEHICLE_LOOKUP,
+        APPOINTMENT_CUSTOMER_LOOKUP,
+        APPOINTMENT_TECHNICIAN_LOOKUP,
+    ]).to_list(100)
     
-    # Get vehicle info for each appointment
-    appointments_with_details = []
-    for apt in appointments:
-        apt_dict = convert_objectid(apt)
-        vin = apt.get("vin")
-        
-        # Get vehicle info
-        vehicle = await db.vehicles.find_one({"vin": vin})
-        if vehicle:
-            apt_dict["vehicle_name"] = vehicle.get("vehicle_name") or vehicle.get("model")
-            apt_dict["plate_number"] = vehicle.get("plate_number")
-        
-        # Get customer info
-        customer_id = apt.get("customer_id")
-        if customer_id:
-            customer = await db.customers.find_one({"customer_id": customer_id})
-            if customer:
-                apt_dict["customer_name"] = customer.get("name")
-        
-        # Get technician name if technician_id is assigned
-        technician_id = apt.get("technician_id")
-        if technician_id:
-            technician = await db.technicians.find_one({"technician_id": technician_id})
-            if technician:
-                apt_dict["technician_name"] = technician.get("name", technician_id)
-            else:
-                apt_dict["technician_name"] = technician_id
-        else:
-            apt_dict["technician_name"] = None
-        
-        appointments_with_details.append(apt_dict)
+    appointments_with_details = [_apply_appointment_details(apt) for apt in appointments]
     
-    return {"status": "success", "appointments": appointments_with_details}
+    return MongoJSONResponse({"status": "success", "appointments": appointments_with_details})
 
 @router.get("/service-centers/{center_id}/technicians")
 async def get_service_center_technicians(
@@ -566,28 +567,29 @@ async def get_service_center_technicians(
     db = get_database()
     
     # Get technicians
-    technicians = await db.technicians.find({"service_center_id": center_id}).to_list(100)
+    technicians = await db.technicians.find({"service_center_id": center_id}).limit(100).batch_size(100).to_list(100)
     
-    # Calculate vehicles repaired last month for each technician
+    # Count completed appointments in the last month for all technicians at once
     one_month_ago = datetime.utcnow() - timedelta(days=30)
+    technician_ids = [tech.get("technician_id") for tech in technicians if tech.get("technician_id")]
+    completed_counts = {
+        row["_id"]: row["count"]
+        async for row in db.service_appointments.aggregate([
+            {"$match": {
+                "technician_id": {"$in": technician_ids},
+                "status": "completed",
+                "updated_at": {"$gte": one_month_ago}
+            }},
+            {"$group": {"_id": "$technician_id", "count": {"$sum": 1}}},
+        ])
+    }
     
     technicians_with_stats = []
     for tech in technicians:
-        tech_dict = convert_objectid(tech)
-        technician_id = tech.get("technician_id")
-        
-        # Count completed appointments in last month
-        completed_count = await db.service_appointments.count_documents({
-            "technician_id": technician_id,
-            "status": "completed",
-            "updated_at": {"$gte": one_month_ago}
-        })
-        
-        tech_dict["vehicles_repaired_last_month"] = completed_count
-        
-        technicians_with_stats.append(tech_dict)
+        tech["vehicles_repaired_last_month"] = completed_counts.get(tech.get("technician_id"), 0)
+        technicians_with_stats.append(tech)
     
-    return {"status": "success", "technicians": technicians_with_stats}
+    return MongoJSONResponse({"status": "success", "technicians": technicians_with_stats})
 
 @router.get("/service-centers/{center_id}/workload")
 async def get_service_center_workload(
@@ -608,28 +610,33 @@ async def get_service_center_workload(
     today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     tomorrow = today + timedelta(days=1)
     
-    # Count scheduled today
-    scheduled_today = await db.service_appointments.count_documents({
-        "service_center_id": center_id,
-        "status": "scheduled",
-        "scheduled_date": {"$gte": today, "$lt": tomorrow}
-    })
-    
-    # Count in progress - use actual appointment status
-    in_progress = await db.service_appointments.count_documents({
-        "service_center_id": center_id,
-        "status": "in_progress"
-    })
-    
-    # Count completed today
-    completed_today = await db.service_appointments.count_documents({
-        "service_center_id": center_id,
-        "status": "completed",
-        "updated_at": {"$gte": today, "$lt": tomorrow}
-    })
+    # All appointment counts in one round-trip, fetched alongside the technicians
+    counts_pipeline = [
+        {"$match": {"service_center_id": center_id, "status": {"$in": ["scheduled", "in_progress", "completed"]}}},
+        {"$facet": {
+            "scheduled_today": [
+                {"$match": {"status": "scheduled", "scheduled_date": {"$gte": today, "$lt": tomorrow}}},
+                {"$count": "n"},
+            ],
+            # In progress - use actual appointment status
+            "in_progress": [{"$match": {"status": "in_progress"}}, {"$count": "n"}],
+            "completed_today": [
+                {"$match": {"status": "completed", "updated_at": {"$gte": today, "$lt": tomorrow}}},
+                {"$count": "n"},
+            ],
+        }},
+    ]
+    count_facets, all_technicians = await asyncio.gather(
+        db.service_appointments.aggregate(counts_pipeline).to_list(1),
+        db.technicians.find({"service_center_id": center_id}, TECHNICIAN_WORKLOAD_PROJECTION)
+        .limit(100).batch_size(100).to_list(100),
+    )
+    counts = {name: facet[0]["n"] if facet else 0 for name, facet in count_facets[0].items()}
+    scheduled_today = counts["scheduled_today"]
+    in_progress = counts["in_progress"]
+    completed_today = counts["completed_today"]
     
     # Count available technicians - only count those with NO current assignments (not working)
-    all_technicians = await db.technicians.find({"service_center_id": center_id}).to_list(100)
     available_technicians = sum(1 for tech in all_technicians 
                               if tech.get("status") == "available" 
                               and tech.get("current_assignments", 0) == 0)
@@ -637,7 +644,6 @@ async def get_service_center_workload(
     # Get workload distribution (technician assignments)
     workload_distribution = []
     for tech in all_technicians:
-        tech_dict = convert_objectid(tech)
         workload_distribution.append({
             "technician_id": tech.get("technician_id"),
             "technician_name": tech.get("name"),
@@ -695,7 +701,7 @@ async def update_appointment_status(
         if technician_id:
             await db.technicians.update_one(
                 {"technician_id": technician_id},
-                {"$inc": {"current_assignments": -1}}
+                {"$inc": {"current_assignments": -1, "available_slots": 1}}
             )
         
         center_id = appointment.get("service_center_id")
@@ -704,6 +710,7 @@ async def update_appointment_status(
                 {"center_id": center_id},
                 {"$inc": {"current_load": -1}}
             )
+            invalidate_service_centers()
         
         # When service completes, refresh vehicle health to a healthy baseline (96%)
         vin = appointment.get("vin")
@@ -719,6 +726,7 @@ async def update_appointment_status(
                     "source": "service_completion",
                     "appointment_id": appointment_id
                 })
+                invalidate_telemetry(vin)
 
                 # Deactivate any active maintenance alerts for this vehicle & customer
                 customer_id = appointment.get("customer_id")
@@ -755,18 +763,18 @@ async def update_appointment_status(
             # Get service center name
             service_center_name = center_id
             if center_id:
-                center = await db.service_centers.find_one({"center_id": center_id})
+                center = await db.service_centers.find_one({"center_id": center_id}, NAME_PROJECTION)
                 if center:
                     service_center_name = center.get("name", center_id)
             
             # Get vehicle info
-            vehicle = await db.vehicles.find_one({"vin": vin})
+            vehicle = await db.vehicles.find_one({"vin": vin}, {"_id": 0, "vehicle_name": 1})
             vehicle_name = vehicle.get("vehicle_name") if vehicle else vin
             
             # Get technician name if assigned
             technician_name = None
             if technician_id:
-                technician = await db.technicians.find_one({"technician_id": technician_id})
+                technician = await db.technicians.find_one({"technician_id": technician_id}, NAME_PROJECTION)
                 if technician:
                     technician_name = technician.get("name", technician_id)
             
@@ -804,67 +812,23 @@ async def update_appointment_status(
             predicted_issue = None
             if vin:
                 try:
-                    prediction_result = await master_agent.failure_prediction_agent.execute({"vin": vin})
+                    prediction_result = await _predict(vin)
                     if prediction_result.get("status") == "success":
                         predicted_issue = prediction_result.get("recommendation", "")
                 except Exception:
                     pass
             
-            # Extract issue category for matching
-            issue_category = None
-            if predicted_issue:
-                issue_lower = predicted_issue.lower()
-                category_mapping = {
-                    "engine": ["engine", "overheating", "temperature", "cooling", "turbo", "oil", "lubrication"],
-                    "electrical": ["electrical", "battery", "voltage", "charging", "wiring", "circuit"],
-                    "brakes": ["brake", "braking", "brake pad", "brake disc"],
-                    "suspension": ["suspension", "shock", "strut", "alignment"],
-                    "transmission": ["transmission", "gearbox", "clutch", "shifting"],
-                    "ac": ["ac", "air conditioning", "cooling system", "heating", "climate"],
-                    "tires": ["tire", "tyre", "wheel", "tread"],
-                    "steering": ["steering", "alignment", "wheel alignment"]
-                }
-                for category, keywords in category_mapping.items():
-                    if any(keyword in issue_lower for keyword in keywords):
-                        issue_category = category.capitalize()
-                        break
-            
-            technician_id = None
-            # First try to find technician with matching specialization
-            if issue_category:
-                matching_technicians = await db.technicians.find({
-                    "service_center_id": center_id,
-                    "status": "available",
-                    "specialization": {"$in": [issue_category]},
-                    "$expr": {"$lt": ["$current_assignments", "$max_capacity"]}
-                }).sort("current_assignments", 1).limit(1).to_list(1)
-                
-                if matching_technicians:
-                    technician_id = matching_technicians[0]["technician_id"]
-            
-            # If no matching specialist found, find any available technician
-            if not technician_id:
-                technicians = await db.technicians.find({
-                    "service_center_id": center_id,
-                    "status": "available",
-                    "$expr": {"$lt": ["$current_assignments", "$max_capacity"]}
-                }).sort("current_assignments", 1).limit(1).to_list(1)
-                
-                if technicians:
-                    technician_id = technicians[0]["technician_id"]
-            
+            # Take the least-loaded available technician, matching specialists first
+            issue_category = extract_issue_category(predicted_issue)
+            technician_id = await claim_technician(db, center_id, issue_category)
             if technician_id:
                 update_data["technician_id"] = technician_id
-                await db.technicians.update_one(
-                    {"technician_id": technician_id},
-                    {"$inc": {"current_assignments": 1}}
-                )
         else:
             # If technician already assigned, increment their assignments
             technician_id = appointment.get("technician_id")
             await db.technicians.update_one(
                 {"technician_id": technician_id},
-                {"$inc": {"current_assignments": 1}}
+                {"$inc": {"current_assignments": 1, "available_slots": -1}}
             )
         
         # Update service center load when starting service
@@ -873,21 +837,21 @@ async def update_appointment_status(
                 {"center_id": center_id},
                 {"$inc": {"current_load": 1}}
             )
+            invalidate_service_centers()
     
     await db.service_appointments.update_one(
         {"appointment_id": appointment_id},
         {"$set": update_data}
     )
     
-    # Convert and return updated appointment
+    # Return updated appointment
     updated_appointment = await db.service_appointments.find_one({"appointment_id": appointment_id})
-    updated_appointment = convert_objectid(updated_appointment) if updated_appointment else None
     
-    return {
+    return MongoJSONResponse({
         "status": "success", 
         "message": f"Appointment status updated to {new_status}",
         "appointment": updated_appointment
-    }
+    })
 
 # Feedback endpoints
 @router.post("/feedback/submit")
@@ -937,7 +901,7 @@ async def get_service_center_feedback(
     
     # Get appointments for this service center
     appointments = await db.service_appointments.find(
-        {"service_center_id": center_id}
+        {"service_center_id": center_id}, {"_id": 0, "appointment_id": 1}
     ).to_list(1000)
     appointment_ids = [apt.get("appointment_id") for apt in appointments]
     
@@ -955,12 +919,12 @@ async def get_service_center_feedback(
     total_rating = sum(f.get("rating", 0) for f in feedbacks)
     avg_rating = total_rating / len(feedbacks)
     
-    return {
+    return MongoJSONResponse({
         "status": "success",
-        "feedback": convert_objectid(feedbacks),
+        "feedback": feedbacks,
         "average_rating": round(avg_rating, 2),
         "total_feedbacks": len(feedbacks)
-    }
+    })
 
 # Manufacturing insights endpoints
 @router.post("/manufacturing/generate-insights")
@@ -986,7 +950,7 @@ async def get_insights(
     if manufacturer:
         query["manufacturer"] = manufacturer
     insights = await db.rcacapa_insights.find(query).sort("created_at", -1).to_list(100)
-    return {"insights": insights}
+    return MongoJSONResponse({"insights": insights})
 
 @router.get("/manufacturing/patterns")
 async def get_patterns(
@@ -1003,11 +967,13 @@ async def get_patterns(
 # Security/UEBA endpoints
 @router.post("/security/analyze")
 async def analyze_security(
+    refresh: bool = False,
     current_user: dict = Depends(require_role("admin"))
 ):
-    """Analyze agent logs for security anomalies"""
+    """Analyze agent logs for security anomalies (latest background run unless refresh=true)"""
     result = await master_agent.ueba_security_agent.execute({
-        "action": "analyze_logs"
+        "action": "analyze_logs",
+        "refresh": refresh
     })
     return result
 
@@ -1018,7 +984,7 @@ async def get_security_events(
     """Get security events"""
     db = get_database()
     events = await db.security_events.find({}).sort("detected_at", -1).limit(100).to_list(100)
-    return {"events": events}
+    return MongoJSONResponse({"events": events})
 
 @router.get("/security/agent/{agent_name}")
 async def check_agent_security(
@@ -1052,6 +1018,7 @@ async def create_vehicle(
     
     vehicle = Vehicle(**vehicle_data)
     await db.vehicles.insert_one(vehicle.dict(by_alias=True))
+    invalidate_vehicle(vehicle.vin)
     return {"status": "success", "vehicle": vehicle.dict()}
 
 @router.get("/vehicles/customer/{customer_id}")
@@ -1080,15 +1047,12 @@ async def get_customer_vehicles(
     vehicles_cursor = db.vehicles.find({"customer_id": customer_id})
     vehicles = await vehicles_cursor.to_list(100)
     
-    # Convert ObjectId to string for JSON serialization
-    vehicles = [convert_objectid(v) for v in vehicles]
-    
     # Debug logging
     print(f"[DEBUG] get_customer_vehicles: customer_id={customer_id}, found {len(vehicles)} vehicles")
     if vehicles:
         print(f"[DEBUG] Vehicle VINs: {[v.get('vin') for v in vehicles[:5]]}")
     
-    return {"customer_id": customer_id, "vehicles": vehicles}
+    return MongoJSONResponse({"customer_id": customer_id, "vehicles": vehicles})
 
 @router.get("/vehicles/{vin}")
 async def get_vehicle(
@@ -1113,8 +1077,7 @@ async def get_vehicle(
                 detail="Access denied: You can only view your own vehicles"
             )
     
-    # Convert ObjectId to string for JSON serialization
-    return convert_objectid(vehicle)
+    return MongoJSONResponse(vehicle)
 
 # Customer endpoints
 @router.post("/customers")
@@ -1126,6 +1089,7 @@ async def create_customer(
     db = get_database()
     customer = Customer(**customer_data)
     await db.customers.insert_one(customer.dict(by_alias=True))
+    invalidate_customer(customer.customer_id)
     return {"status": "success", "customer": customer.dict()}
 
 @router.get("/customers/{customer_id}")
@@ -1138,7 +1102,7 @@ async def get_customer(
     customer = await db.customers.find_one({"customer_id": customer_id})
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    return customer
+    return MongoJSONResponse(customer)
 
 # AI Notification System - Proactive Maintenance Alerts
 @router.post("/notifications/check-and-create")
@@ -1173,7 +1137,7 @@ async def check_and_create_alerts(
             )
     
     # Get all vehicles for customer
-    vehicles = await db.vehicles.find({"customer_id": customer_id}).to_list(100)
+    vehicles = await db.vehicles.find({"customer_id": customer_id}, VEHICLE_SUMMARY_PROJECTION).to_list(100)
     
     # Get existing scheduled appointments
     appointments = await db.service_appointments.find({
@@ -1189,6 +1153,7 @@ async def check_and_create_alerts(
         "status": "active",
         "type": "maintenance_alert"
     }).to_list(1000)
+    deactivated_alert_ids = set()
     
     for old_alert in all_existing_alerts:
         old_vin = old_alert.get("vin")
@@ -1201,7 +1166,7 @@ async def check_and_create_alerts(
         
         # Re-check if alert is still valid by running prediction
         try:
-            old_prediction = await master_agent.failure_prediction_agent.execute({"vin": old_vin})
+            old_prediction = await _predict(old_vin)
             old_health = old_prediction.get("health_score", 100.0)
             old_risk = old_prediction.get("risk_score", 0.0)
             
@@ -1216,6 +1181,7 @@ async def check_and_create_alerts(
                     {"notification_id": old_alert.get("notification_id")},
                     {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}}
                 )
+                deactivated_alert_ids.add(old_alert.get("notification_id"))
                 continue  # Skip to next alert
             
             if not still_valid:
@@ -1224,12 +1190,20 @@ async def check_and_create_alerts(
                     {"notification_id": old_alert.get("notification_id")},
                     {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}}
                 )
+                deactivated_alert_ids.add(old_alert.get("notification_id"))
         except Exception as e:
             # If we can't check, deactivate the alert to be safe
             await db.notifications.update_one(
                 {"notification_id": old_alert.get("notification_id")},
                 {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}}
             )
+            deactivated_alert_ids.add(old_alert.get("notification_id"))
+    
+    # Index the alerts that survived cleanup by VIN instead of querying per vehicle
+    active_alerts_by_vin = {}
+    for old_alert in all_existing_alerts:
+        if old_alert.get("notification_id") not in deactivated_alert_ids and old_alert.get("vin"):
+            active_alerts_by_vin.setdefault(old_alert["vin"], old_alert)
     
     alerts_created = []
     
@@ -1250,7 +1224,7 @@ async def check_and_create_alerts(
             
             # Try to get health score from failure prediction agent
             try:
-                prediction_result = await master_agent.failure_prediction_agent.execute({"vin": vin})
+                prediction_result = await _predict(vin)
                 if prediction_result.get("status") == "success":
                     risk_score = prediction_result.get("risk_score", 0.0)
                     health_score = prediction_result.get("health_score", 100.0)
@@ -1260,12 +1234,11 @@ async def check_and_create_alerts(
             except Exception as agent_error:
                 # Fallback: Check telemetry directly if agent fails
                 print(f"Prediction agent failed for {vin}, checking telemetry directly: {str(agent_error)}")
-                recent_telemetry = await db.vehicle_telemetry.find(
-                    {"vin": vin}
-                ).sort("timestamp", -1).limit(1).to_list(1)
+                latest_telemetry = await db.vehicle_telemetry.find_one(
+                    {"vin": vin}, TELEMETRY_HEALTH_PROJECTION, sort=[("timestamp", -1)]
+                )
                 
-                if recent_telemetry and len(recent_telemetry) > 0:
-                    latest_telemetry = recent_telemetry[0]
+                if latest_telemetry is not None:
                     health_score = latest_telemetry.get("health_score", 100.0)
                     risk_score = latest_telemetry.get("prediction_risk", 0.0)
                     
@@ -1282,11 +1255,10 @@ async def check_and_create_alerts(
                         telemetry_result = await master_agent.telemetry_agent.execute({"vin": vin})
                         if telemetry_result.get("status") == "success":
                             # Now try to get the health score again
-                            recent_telemetry = await db.vehicle_telemetry.find(
-                                {"vin": vin}
-                            ).sort("timestamp", -1).limit(1).to_list(1)
-                            if recent_telemetry and len(recent_telemetry) > 0:
-                                latest_telemetry = recent_telemetry[0]
+                            latest_telemetry = await db.vehicle_telemetry.find_one(
+                                {"vin": vin}, TELEMETRY_HEALTH_PROJECTION, sort=[("timestamp", -1)]
+                            )
+                            if latest_telemetry is not None:
                                 health_score = latest_telemetry.get("health_score", 100.0)
                                 risk_score = latest_telemetry.get("prediction_risk", 0.0)
                                 if risk_score == 0.0:
@@ -1310,12 +1282,7 @@ async def check_and_create_alerts(
             # Show alerts for vehicles that need attention (health < 70)
             
             # Check if alert already exists for this vehicle
-            existing_alert = await db.notifications.find_one({
-                "vin": vin,
-                "customer_id": customer_id,
-                "status": "active",
-                "type": "maintenance_alert"
-            })
+            existing_alert = active_alerts_by_vin.get(vin)
             
             if needs_alert:
                 print(f"[ALERT CREATION] Vehicle {vin} needs alert (health={health_score:.2f}% < 70%)")
@@ -1375,12 +1342,12 @@ async def check_and_create_alerts(
             continue
     
     print(f"[ALERT SUMMARY] Created {len(alerts_created)} new alerts for customer {customer_id}")
-    return {
+    return MongoJSONResponse({
         "status": "success",
         "alerts_created": len(alerts_created),
         "alerts": alerts_created,
         "total_vehicles_checked": len(vehicles)
-    }
+    })
 
 @router.get("/notifications/customer/{customer_id}")
 async def get_customer_notifications(
@@ -1444,17 +1411,14 @@ async def get_customer_notifications(
             # For other notification types (like service_completed), include them
             valid_notifications.append(notif)
     
-    # Convert ObjectId to string for JSON serialization
-    valid_notifications = [convert_objectid(notif) for notif in valid_notifications]
-    
     # If filtering by type, return appropriate key
     if notification_type == "maintenance_alert":
-        return {"alerts": valid_notifications}
+        return MongoJSONResponse({"alerts": valid_notifications})
     elif notification_type == "service_completed":
-        return {"completions": valid_notifications}
+        return MongoJSONResponse({"completions": valid_notifications})
     else:
         # Return all notifications separated by type
         alerts = [n for n in valid_notifications if n.get("type") == "maintenance_alert"]
         completions = [n for n in valid_notifications if n.get("type") == "service_completed"]
-        return {"alerts": alerts, "completions": completions}
+        return MongoJSONResponse({"alerts": alerts, "completions": completions})
 
@@ -10,6 +10,8 @@ class Settings(BaseSettings):
     # MongoDB
     MONGODB_URL: str = "mongodb://localhost:27017"
     MONGODB_DB_NAME: str = "automotive_aftermarket"
+    MONGODB_MAX_POOL_SIZE: int = 100
+    MONGODB_MIN_POOL_SIZE: int = 10
     
     # Security
     SECRET_KEY: str = "your-secret-key-change-in-production"
@@ -1,17 +1,26 @@
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from pymongo.errors import ConnectionFailure
 from pymongo.errors import ServerSelectionTimeoutError
 from pymongo.errors import PyMongoError
+from pymongo.errors import CollectionInvalid
 import asyncio
 from app.core.config import settings
 
 
 class MongoDB:
     client: AsyncIOMotorClient = None
+    # Database handle resolved once per connection and shared by get_database()
+    database: AsyncIOMotorDatabase = None
 
 
 db = MongoDB()
 
+# Indexes created by earlier releases that are covered by the current compound
+# indexes; init_database drops them if present
+SUPERSEDED_INDEXES = {
+    "service_appointments": ("idx_appts_customer_date",),
+}
+
 
 async def connect_to_mongo(retries: int = 3, timeout_ms: int = 5000):
     """Create database connection with retries and a server selection timeout.
@@ -24,12 +33,19 @@ async def connect_to_mongo(retries: int = 3, timeout_ms: int = 5000):
     last_err = None
     for attempt in range(1, retries + 1):
         try:
-            # Set a short server selection timeout so failures surface quickly
-            db.client = AsyncIOMotorClient(mongodb_url, serverSelectionTimeoutMS=timeout_ms)
+            # Set a short server selection timeout so failures surface quickly.
+            # One client (and connection pool) is shared by the whole app.
+            db.client = AsyncIOMotorClient(
+                mongodb_url,
+                serverSelectionTimeoutMS=timeout_ms,
+                maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+                minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+            )
             # Test connection
             await db.client.admin.command("ping")
             print(f"Connected to MongoDB ({db_name}) on attempt {attempt}")
-            return db.client[db_name]
+            db.database = db.client[db_name]
+            return db.database
         except (ConnectionFailure, ServerSelectionTimeoutError, PyMongoError) as e:
             last_err = e
             print(f"Attempt {attempt} - Failed to connect to MongoDB: {e}")
@@ -52,6 +68,7 @@ async def close_mongo_connection():
     """Close database connection."""
     if db.client:
         try:
+            db.database = None
             db.client.close()
             print("MongoDB connection closed")
         except Exception as e:
@@ -63,12 +80,11 @@ def get_database():
 
     Raises a helpful error if the database client is not connected yet.
     """
-    db_name = settings.MONGODB_DB_NAME
-    if not db.client:
+    if db.database is None:
         raise RuntimeError(
             "MongoDB client is not initialized. Ensure the FastAPI app ran startup and `connect_to_mongo` succeeded."
         )
-    return db.client[db_name]
+    return db.database
 
 
 async def init_database():
@@ -112,6 +128,13 @@ async def init_database():
                 # Collection was created in a race condition – safe to ignore
                 pass
 
+    # Drop indexes that later compound indexes made redundant
+    for collection, names in SUPERSEDED_INDEXES.items():
+        existing = await database[collection].index_information()
+        for name in names:
+            if name in existing:
+                await database[collection].drop_index(name)
+
     # Create indexes (idempotent; MongoDB skips if already exist)
     await database.users.create_index("username", unique=True, name="idx_users_username_unique")
     await database.users.create_index("email", unique=True, name="idx_users_email_unique")
@@ -127,19 +150,82 @@ async def init_database():
     )
 
     await database.service_centers.create_index("center_id", unique=True, name="idx_centers_id_unique")
+    await database.service_centers.create_index(
+        [("status", 1), ("center_id", 1)], name="idx_centers_status"
+    )
 
+    await database.technicians.create_index("technician_id", unique=True, name="idx_tech_id_unique")
     await database.technicians.create_index(
         [("service_center_id", 1), ("technician_id", 1)], name="idx_tech_center_tech"
     )
+    # Technician claims filter by centre + status + free slots and take the
+    # least loaded (equality, sort, then range keys)
+    await database.technicians.create_index(
+        [("service_center_id", 1), ("status", 1), ("current_assignments", 1), ("available_slots", 1)],
+        name="idx_tech_center_status_load_slots",
+    )
+    # Backfill the denormalised free-slot count on technicians created without it
+    await database.technicians.update_many(
+        {"available_slots": {"$exists": False}},
+        [{"$set": {"available_slots": {"$subtract": [
+            {"$ifNull": ["$max_capacity", 3]}, {"$ifNull": ["$current_assignments", 0]}
+        ]}}}],
+    )
 
     await database.service_appointments.create_index(
-        [("customer_id", 1), ("scheduled_date", -1)], name="idx_appts_customer_date"
+        "appointment_id", unique=True, name="idx_appts_id_unique"
+    )
+    # Customer and service centre listings filter on owner + status and sort or
+    # range on scheduled_date (equality, sort, then range keys)
+    await database.service_appointments.create_index(
+        [("customer_id", 1), ("status", 1), ("scheduled_date", -1)], name="idx_appts_customer_status_date"
+    )
+    await database.service_appointments.create_index(
+        [("service_center_id", 1), ("status", 1), ("scheduled_date", -1)], name="idx_appts_center_status_date"
+    )
+    # Per-technician completed counts over a recent updated_at window
+    await database.service_appointments.create_index(
+        [("technician_id", 1), ("status", 1), ("updated_at", 1)], name="idx_appts_tech_status_updated"
+    )
+
+    # Active notifications per customer, newest first (alert checks and listings)
+    await database.notifications.create_index(
+        [("customer_id", 1), ("status", 1), ("created_at", -1)], name="idx_notifications_customer_status_created"
+    )
+    # Unread alerts per vehicle (chat / engagement). Partial so read notifications
+    # are not indexed at all.
+    await database.notifications.create_index(
+        [("vin", 1), ("read", 1), ("timestamp", -1)],
+        name="idx_notifications_vin_unread_ts",
+        partialFilterExpression={"read": False},
+    )
+
+    await database.feedbacks.create_index("vin", name="idx_feedbacks_vin")
+    await database.feedbacks.create_index("appointment_id", name="idx_feedbacks_appointment")
+
+    # Failure pattern upserts match on these keys; insight generation filters
+    # and sorts by occurrence count
+    await database.failure_patterns.create_index(
+        [("manufacturer", 1), ("model", 1), ("error_codes", 1), ("component", 1)],
+        name="idx_patterns_lookup",
+    )
+    await database.failure_patterns.create_index(
+        [("occurrence_count", -1)], name="idx_patterns_occurrences"
+    )
+
+    # One insight per failure pattern; insight upserts rely on this
+    await database.rcacapa_insights.create_index(
+        "failure_pattern_id", unique=True, name="idx_insights_pattern_unique"
     )
 
     await database.agent_logs.create_index(
         [("agent_name", 1), ("timestamp", -1)], name="idx_agent_logs_agent_ts"
     )
+    # UEBA log analysis scans the last 24 hours across all agents
+    await database.agent_logs.create_index([("timestamp", -1)], name="idx_agent_logs_ts")
 
+    # UEBA event upserts match on event_id, which is derived from the source log
+    await database.security_events.create_index("event_id", unique=True, name="idx_sec_events_id_unique")
     await database.security_events.create_index(
         [("event_type", 1), ("detected_at", -1)], name="idx_sec_events_type_ts"
     )
@@ -0,0 +1,109 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+from cachetools import TTLCache
+from app.core.database import get_database
+
+# Short-lived read cache for documents that are re-read in bursts (dashboard
+# polling, chat sessions). Entries expire after a few seconds and are dropped
+# explicitly whenever the application writes the underlying document.
+CACHE_MAXSIZE = 10_000
+CACHE_TTL_SECONDS = 5
+
+# Failure predictions are costlier to recompute and only change with new
+# telemetry, so they are kept longer and dropped with the vehicle's telemetry
+PREDICTION_CACHE_TTL_SECONDS = 30
+
+# Cached documents only carry the fields the agents read
+VEHICLE_PROJECTION = {
+    "_id": 0, "vin": 1, "vehicle_name": 1, "model": 1, "manufacturer": 1,
+    "plate_number": 1, "customer_id": 1,
+}
+CUSTOMER_PROJECTION = {"_id": 0, "customer_id": 1, "name": 1}
+LATEST_TELEMETRY_PROJECTION = {
+    "_id": 0, "vin": 1, "timestamp": 1, "health_score": 1, "prediction_risk": 1,
+    "engine_temperature": 1, "oil_pressure": 1, "battery_voltage": 1, "vibration_level": 1,
+}
+
+_cache: TTLCache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL_SECONDS)
+_prediction_cache: TTLCache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=PREDICTION_CACHE_TTL_SECONDS)
+_locks: Dict[Hashable, asyncio.Lock] = {}
+
+
+async def _get_or_load(
+    key: Hashable, loader: Callable[[], Awaitable[Any]], cache: TTLCache = _cache
+) -> Any:
+    """Return cached value for key, loading it at most once per expiry window"""
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+
+    # Single-flight: concurrent misses on the same key wait for one loader
+    lock = _locks.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            try:
+                return cache[key]
+            except KeyError:
+                value = await loader()
+                cache[key] = value
+                return value
+    finally:
+        if _locks.get(key) is lock and not lock.locked():
+            del _locks[key]
+
+
+async def get_vehicle(vin: str) -> Optional[Dict[str, Any]]:
+    """Get vehicle document by VIN"""
+    db = get_database()
+    return await _get_or_load(("vehicle", vin), lambda: db.vehicles.find_one({"vin": vin}, VEHICLE_PROJECTION))
+
+
+async def get_customer(customer_id: str) -> Optional[Dict[str, Any]]:
+    """Get customer document by customer ID"""
+    db = get_database()
+    return await _get_or_load(
+        ("customer", customer_id), lambda: db.customers.find_one({"customer_id": customer_id}, CUSTOMER_PROJECTION)
+    )
+
+
+async def get_latest_telemetry(vin: str) -> Optional[Dict[str, Any]]:
+    """Get the most recent telemetry document for a vehicle"""
+    db = get_database()
+    return await _get_or_load(
+        ("telemetry", vin),
+        lambda: db.vehicle_telemetry.find_one(
+            {"vin": vin}, LATEST_TELEMETRY_PROJECTION, sort=[("timestamp", -1)]
+        ),
+    )
+
+
+async def get_active_service_centers() -> List[Dict[str, Any]]:
+    """Get active service centers (up to 100); callers must not mutate the list"""
+    db = get_database()
+    return await _get_or_load(
+        ("service_centers", "active"),
+        lambda: db.service_centers.find({"status": "active"}).limit(100).batch_size(100).to_list(100),
+    )
+
+
+async def get_prediction(vin: str, predict: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Get a failure prediction for a vehicle, running predict only on a miss; callers must not mutate it"""
+    return await _get_or_load(("prediction", vin), predict, _prediction_cache)
+
+
+def invalidate_vehicle(vin: str) -> None:
+    _cache.pop(("vehicle", vin), None)
+
+
+def invalidate_customer(customer_id: str) -> None:
+    _cache.pop(("customer", customer_id), None)
+
+
+def invalidate_telemetry(vin: str) -> None:
+    _cache.pop(("telemetry", vin), None)
+    _prediction_cache.pop(("prediction", vin), None)
+
+
+def invalidate_service_centers() -> None:
+    _cache.pop(("service_centers", "active"), None)
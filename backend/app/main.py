@@ -1,9 +1,11 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import ORJSONResponse, Response
 from contextlib import asynccontextmanager
 from app.core.database import connect_to_mongo, close_mongo_connection, init_database
 from app.core.config import settings
+from app.agents.telemetry_agent import start_telemetry_writer, stop_telemetry_writer
+from app.utils.logger import start_log_writer, stop_log_writer
 from app.api import routes, auth
 
 
@@ -19,12 +21,18 @@ async def lifespan(app: FastAPI):
             await init_database()
         except Exception as e:
             print(f"Warning: database initialization failed: {e}")
+        start_log_writer()
+        start_telemetry_writer()
+        routes.master_agent.ueba_security_agent.start_background_analysis()
     except Exception as e:
         print(f"Warning: could not connect to MongoDB during startup: {e}")
 
     yield
 
-    # Shutdown - close connection if present
+    # Shutdown - flush queued telemetry and agent logs, then close connection if present
+    await routes.master_agent.ueba_security_agent.stop_background_analysis()
+    await stop_telemetry_writer()
+    await stop_log_writer()
     try:
         await close_mongo_connection()
     except Exception as e:
@@ -35,6 +43,8 @@ app = FastAPI(
     title=settings.APP_NAME,
     version=settings.VERSION,
     lifespan=lifespan,
+    # orjson serializes datetimes natively, so payloads can carry them as-is
+    default_response_class=ORJSONResponse,
 )
 
 # CORS middleware - Allow all origins in development
@@ -33,6 +33,11 @@ class RCACAPAAction(BaseModel):
     due_date: Optional[datetime] = None
     status: str = Field(default="pending", description="pending, in_progress, completed")
 
+    class Config:
+        # Action templates are shared between insights, so instances must not change
+        frozen = True
+        extra = "forbid"
+
 
 class RCACAPAInsight(BaseModel):
     id: Optional[PyObjectId] = Field(default_factory=PyObjectId, alias="_id")
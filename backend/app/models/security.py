@@ -27,8 +27,11 @@ class AgentLog(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     input_data: dict = Field(default_factory=dict, description="Input data")
     output_data: dict = Field(default_factory=dict, description="Output data")
+    input_data_size: int = Field(default=0, ge=0, description="Number of top-level input_data fields")
+    output_data_size: int = Field(default=0, ge=0, description="Number of top-level output_data fields")
     execution_time_ms: float = Field(default=0.0, description="Execution time in milliseconds")
     status: str = Field(default="success", description="success, error, warning")
+    is_error: bool = Field(default=False, description="status == 'error', stored for UEBA features")
     error_message: Optional[str] = None
     
     # UEBA fields
@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from bson import ObjectId
 from app.models.vehicle import PyObjectId
 
@@ -42,6 +42,10 @@ class Technician(BaseModel):
     specialization: list[str] = Field(default_factory=list, description="Specializations")
     current_assignments: int = Field(default=0, ge=0, description="Current number of assigned services")
     max_capacity: int = Field(default=3, ge=1, description="Maximum concurrent assignments")
+    available_slots: int = Field(
+        default=3,
+        description="max_capacity - current_assignments unless given, kept in step with every assignment $inc",
+    )
     status: str = Field(default="available", description="available, busy, off_duty")
     vehicles_repaired_last_month: int = Field(default=0, ge=0, description="Number of vehicles repaired in last month")
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -50,3 +54,10 @@ class Technician(BaseModel):
         populate_by_name = True
         arbitrary_types_allowed = True
 
+    @model_validator(mode="after")
+    def derive_available_slots(self) -> "Technician":
+        """Default available_slots from capacity and load when not set explicitly"""
+        if "available_slots" not in self.model_fields_set:
+            self.available_slots = self.max_capacity - self.current_assignments
+        return self
+
@@ -0,0 +1,20 @@
+import os
+import threading
+
+# Random bytes are drawn from the OS in bulk and handed out 4 at a time, so
+# generating a short ID does not cost a getrandom() syscall each time.
+_POOL_REFILL_BYTES = 4096
+_ID_BYTES = 4
+
+_id_pool = bytearray()
+_id_lock = threading.Lock()
+
+
+def short_id() -> str:
+    """Return a random 8-character uppercase hex ID (e.g. for FB_/APT_ prefixes)"""
+    with _id_lock:
+        if len(_id_pool) < _ID_BYTES:
+            _id_pool.extend(os.urandom(_POOL_REFILL_BYTES))
+        chunk = bytes(_id_pool[:_ID_BYTES])
+        del _id_pool[:_ID_BYTES]
+    return chunk.hex().upper()
@@ -1,9 +1,23 @@
+import asyncio
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 from app.core.database import get_database
 from app.models.security import AgentLog
 
-async def log_agent_action(
+# Agent logs are queued in-process and written by a single background task in
+# batches, so logging never adds a database round trip to an agent call.
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL_SECONDS = 0.2
+LOG_QUEUE_MAXSIZE = 10_000
+
+_log_queue: asyncio.Queue = asyncio.Queue(maxsize=LOG_QUEUE_MAXSIZE)
+_writer_task: Optional[asyncio.Task] = None
+# Queued after everything else by stop_log_writer; the writer writes the batch
+# in hand and exits when it reaches it
+_STOP_WRITER = object()
+
+
+def log_agent_action(
     agent_name: str,
     action: str,
     input_data: Dict[str, Any] = None,
@@ -14,19 +28,89 @@ async def log_agent_action(
     anomaly_score: float = 0.0,
     is_anomaly: bool = False
 ) -> None:
-    """Log agent action for UEBA analysis"""
-    db = get_database()
+    """Queue agent action log for UEBA analysis"""
+    input_data = input_data or {}
+    output_data = output_data or {}
     log_entry = AgentLog(
         agent_name=agent_name,
         action=action,
         timestamp=datetime.utcnow(),
-        input_data=input_data or {},
-        output_data=output_data or {},
+        input_data=input_data,
+        output_data=output_data,
+        input_data_size=len(input_data),
+        output_data_size=len(output_data),
         execution_time_ms=execution_time_ms,
         status=status,
+        is_error=status == "error",
         error_message=error_message,
         anomaly_score=anomaly_score,
         is_anomaly=is_anomaly
     )
-    await db.agent_logs.insert_one(log_entry.dict(by_alias=True))
+    try:
+        _log_queue.put_nowait(log_entry.dict(by_alias=True))
+    except asyncio.QueueFull:
+        print(f"Warning: agent log queue full, dropping log for {agent_name}")
+
+
+async def _write_batch(batch: List[Dict[str, Any]]) -> None:
+    try:
+        db = get_database()
+        await db.agent_logs.insert_many(batch, ordered=False)
+    except Exception as e:
+        print(f"Warning: failed to write {len(batch)} agent logs: {e}")
+
+
+async def _drain_log_queue() -> None:
+    """Write queued logs in batches of up to LOG_BATCH_SIZE every LOG_FLUSH_INTERVAL_SECONDS
+    until the stop sentinel"""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _log_queue.get()
+        if item is _STOP_WRITER:
+            return
+        batch = [item]
+        deadline = loop.time() + LOG_FLUSH_INTERVAL_SECONDS
+        try:
+            while len(batch) < LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(_log_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP_WRITER:
+                    await _write_batch(batch)
+                    return
+                batch.append(item)
+        except asyncio.CancelledError:
+            # Cancelled while collecting: store what was already taken off the queue
+            await _write_batch(batch)
+            raise
+        await _write_batch(batch)
+
+
+def start_log_writer() -> None:
+    """Start the background agent log writer (idempotent)"""
+    global _writer_task
+    if _writer_task is None or _writer_task.done():
+        _writer_task = asyncio.create_task(_drain_log_queue())
+
+
+async def stop_log_writer() -> None:
+    """Stop the background writer once it has written everything queued so far"""
+    global _writer_task
+    if _writer_task is not None:
+        if not _writer_task.done():
+            await _log_queue.put(_STOP_WRITER)
+            await _writer_task
+        _writer_task = None
 
+    # Logs queued after the writer exited
+    remaining = []
+    while not _log_queue.empty():
+        item = _log_queue.get_nowait()
+        if item is not _STOP_WRITER:
+            remaining.append(item)
+    for i in range(0, len(remaining), LOG_BATCH_SIZE):
+        await _write_batch(remaining[i:i + LOG_BATCH_SIZE])
@@ -99,6 +99,7 @@ db.technicians.insertOne({
   specialization: ["Engine", "Electrical"],
   current_assignments: 0,
   max_capacity: 3,
+  available_slots: 3,
   status: "available",
   created_at: new Date()
 });
@@ -721,6 +721,7 @@ async def init_demo_data():
     ]
     
     for technician in technicians:
+        technician["available_slots"] = technician["max_capacity"] - technician["current_assignments"]
         existing_tech = await db.technicians.find_one({"technician_id": technician["technician_id"]})
         if not existing_tech:
             await db.technicians.insert_one(technician)